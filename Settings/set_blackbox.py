@@ -10,6 +10,22 @@ __version__ = '0.7.1'
 nproc = 2
 # maximum number of threads for each process
 nthread = 2
+# number of threads used to decompress the tiles of fpacked images,
+# which are decompressed in memory; 1 decompresses them in one go
+decompress_nthread = 1
+
+# switch to run each of the [nproc] processes as a separate worker and
+# route the images of the same field and filter (and the flats of the
+# same filter) to the same worker (True), so that the master frames,
+# bad pixel mask and reference files it caches are reused, rather than
+# to whichever process is free (False); a worker that is idle takes
+# over an image waiting for another worker after
+# [affinity_steal_wait] seconds, which should be a fair fraction of
+# the time it takes to reduce an image, as the worker may become free
+# before then. The number of images and cache hit rates of each worker
+# are logged at the end.
+affinity = False
+affinity_steal_wait = 60
 
 #===============================================================================
 # Directory structure and files to keep
@@ -25,6 +41,48 @@ ref_dir = '{}/ref'.format(run_dir)
 # read/write speed
 tmp_dir = '{}/tmp'.format(run_dir)
 
+# SQLite cache of the headers of the raw images, so that they do not
+# need to be read again when a date is rerun or night mode restarted;
+# set to None to always read the headers from the images
+header_cache = '{}/header_cache.sqlite'.format(run_dir)
+
+# in day mode, criterion to select the object image of a field and
+# filter from which the reference image is made, if it does not exist
+# yet: 'first' (earliest), 'exptime' (longest exposure time) or
+# 'airmass' (lowest airmass)
+ref_select = 'first'
+
+# order in which the images found in night mode are reduced: 'fifo'
+# (order of arrival), 'newest' (most recent object images first,
+# calibration frames last), 'calib_first' (bias and flat frames first)
+# or 'deadline' (earliest deadline first, where the deadline is the
+# arrival time plus the latency in seconds allowed for the field
+# (OBJECT) in [night_deadline], or for 'default' otherwise); with any
+# policy, object images wait for the bias frames of their night and
+# the flats of their night and filter that are waiting to be reduced
+night_policy = 'fifo'
+night_deadline = {'default': 600}
+# maximum number of images waiting to be reduced in night mode; any
+# further object images are deferred (the lowest-ranked according to
+# [night_policy]) to a backlog that is only reduced when no other
+# images can be reduced; None for no maximum
+night_depth = None
+# JSON file to which the state of the night-mode queue is written
+# every 10 seconds for monitoring, with {} replaced by the telescope;
+# None to not write it
+night_state_file = '{}/{{}}/night_queue.json'.format(log_dir)
+
+# switch to let ZOGY read the reduced image and mask from memory
+# rather than reading back the files in [tmp_dir], and to copy the
+# products of the new images that are kept from [tmp_dir] to their
+# destination (compressing them if [compress_output] is True) in the
+# background while the next image is processed (True). N.B.: all
+# products, including the reduced image and mask, are still written
+# to [tmp_dir] first, as the external programs that ZOGY runs
+# (SExtractor, PSFEx) need them, so only the reading back (often from
+# the page cache) and the final copy/compression are saved
+zogy_handoff = False
+
 # switch to keep tmp directories (True) or not (False)
 keep_tmp = True
 
@@ -34,6 +92,28 @@ ref_2keep = ['_ldac.fits', '_psf.fits', '_psfex.cat'] + all_2keep
 new_2keep = ['_D.fits', '_Scorr.fits', '_Fpsf.fits','_Fpsferr.fits',
              '_trans.fits'] + all_2keep
 
+# switch to write the reduced bias and flat frames, the masters and
+# the images in [compress_2keep] that are kept for the new images
+# tile-compressed (fpacked; True) with the extension .fz added to
+# their names, or uncompressed (False); the reference images and the
+# images in [tmp_dir] that are used by ZOGY are not compressed
+compress_output = False
+compress_2keep = ['_red.fits', '_mask.fits', '_D.fits', '_Scorr.fits']
+# compression algorithm: 'RICE_1', 'HCOMPRESS_1' or 'GZIP_2'; integer
+# images such as the mask are compressed losslessly
+compress_type = 'RICE_1'
+# quantization of floating-point images: noise level divided by
+# [compress_quantize_level] is the quantization step; method 2
+# (SUBTRACTIVE_DITHER_2) preserves pixels with value zero
+compress_quantize_level = 16
+compress_quantize_method = 2
+# HCOMPRESS scale factor; 0 is lossless for integer images
+compress_hcomp_scale = 0
+# number of threads over which the images to be compressed are
+# divided, one image per thread; astropy releases the GIL while it
+# compresses the tiles, so the threads run in parallel
+compress_nthread = nthread
+
 
 #===============================================================================
 # Calibration files
@@ -41,10 +121,75 @@ new_2keep = ['_D.fits', '_Scorr.fits', '_Fpsf.fits','_Fpsferr.fits',
 
 # name of Xtalk file created by Kerry
 crosstalk_file = os.environ['ZOGYHOME']+'/CalFiles/crosstalk_20180620.txt'
+# number of rows of all channels that are corrected for crosstalk at
+# once; a block of all channels should comfortably fit in the CPU cache
+xtalk_nrows = 64
+
+# SQLite index of the master bias and flat frames in [red_dir], used to
+# find the closest master when there are too few frames to make one;
+# rebuild it with: python blackbox.py --rebuild_cal_index
+cal_index = '{}/cal_index.sqlite'.format(red_dir)
+
+# maximum total size in MB of the master bias and flat frames that are
+# kept in memory by each process, so that they do not need to be read
+# again for the next image; a reduced master is about 450 MB
+master_cache_mb = 2000
+
+# maximum total size in MB of the reference images, masks and their
+# PSF and catalog files that are kept in memory by each process, so
+# that ZOGY does not need to read them again for the next image of the
+# same field and filter; a reference image is about 450 MB. The cached
+# arrays are passed to ZOGY read-only. 0 switches the reference cache
+# off
+ref_cache_mb = 0
+
+# switch to share the master bias and flat frames and the bad pixel
+# mask between the [nproc] processes (True), rather than each process
+# reading its own copy (False); the first process that needs a
+# calibration file publishes its data as a file in [shm_dir], which
+# all processes map into memory read-only; when the masters of a new
+# night are published, those of earlier nights are removed
+shared_cal = False
+# directory of the shared calibration files; should be on a
+# memory-backed filesystem such as /dev/shm
+shm_dir = '/dev/shm/blackbox'
+
+# method used to combine the individual bias and flat frames into a
+# master: 'median' or 'clipped_mean' (sigma-clipped mean)
+combine_method = 'median'
+# approximate maximum memory in MB used in combining the frames; the
+# frames are combined in strips of rows that fit within this memory
+combine_mem_mb = 1000
+# number of threads over which the strips are divided
+combine_nthread = nthread
 
 # name of initial bad pixel mask
 bad_pixel_mask = os.environ['ZOGYHOME']+'/CalFiles/bpm_u_0p05.fits'
+# bad pixel masks for specific filters and/or dates, as a list of
+# tuples (filter, first evening date yyyymmdd, file name), where a
+# filter or date of None applies to all filters or dates; the last
+# entry that applies to the filter and date of an image is used, or
+# [bad_pixel_mask] if none applies. Fpacked masks (.fz) are also found.
+bpm_list = []
         
+#===============================================================================
+# Reduction steps
+#===============================================================================
+
+# switch to correct object images for the gain, crosstalk, overscan,
+# master bias and master flat in a single pass through the image
+# (True), rather than one step after the other (False); only used if
+# the master bias and flat are already available
+fused_reduce = False
+# number of rows of all channels processed at once in the fused reduction
+fused_nrows = 64
+
+# switch to process the channels in parallel on [nthread] threads
+# (True) in the gain and overscan corrections and the master bias
+# channel statistics, rather than one after the other (False); see
+# [blackbox.bench_chan_parallel] to compare the two
+chan_parallel = False
+
 #===============================================================================
 # Cosmic ray and satellite trail detection
 #===============================================================================
@@ -57,8 +202,32 @@ sigfrac = 0.3
 objlim = 10.0
 niter = 3
 
+# switch to detect the cosmic rays in tiles of the channel data
+# sections extended by [cosmics_margin] pixels on each side, divided
+# over [cosmics_nthread] threads (True), rather than in the full
+# frame at once (False); the margin should be wide enough for the
+# detection in the channel data sections to be unaffected by the tile
+# edges, which grows with [niter]
+cosmics_tiled = False
+cosmics_margin = 32
+cosmics_nthread = nthread
+# switch to also detect the cosmic rays in the full frame when
+# [cosmics_tiled] is True and log the differences with the tiled
+# detection; only meant for validation as it doubles the time
+cosmics_validate = False
+
 # binning used for satellite trail detection
 sat_bin = 2
+# switch to first screen the images for satellite trails on a
+# heavily binned image (True) and only run the full detection if the
+# pre-filter score (the largest fraction of high pixels along a
+# straight line in the binned image) is at least
+# [sat_prefilter_thresh]; the score and whether the full detection was
+# run are recorded in the header keywords SAT-PRE and SAT-FULL
+sat_prefilter = False
+sat_prefilter_bin = 16
+sat_prefilter_nsigma = 3.
+sat_prefilter_thresh = 0.25
 
 #===============================================================================
 # CCD settings and definition of channel/data/overscan/normalisation sections
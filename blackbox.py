@@ -5,23 +5,40 @@ from Settings import set_blackbox, set_zogy
 os.environ['OMP_NUM_THREADS'] = str(set_blackbox.nthread)
 
 from zogy import *
+import zogy
 
 import re   # Regular expression operations
 import glob # Unix style pathname pattern expansion 
-from multiprocessing import Pool, Manager, Lock, Queue
+from multiprocessing import Pool, Manager, Lock
+from multiprocessing.pool import ThreadPool
 import datetime as dt 
 from dateutil.tz import gettz
 from astropy.stats import sigma_clipped_stats
 from scipy import ndimage
+from skimage.transform import hough_line, probabilistic_hough_line
+from skimage.feature import canny
+from skimage import exposure, morphology
 import astroscrappy
-from acstools.satdet import detsat, make_mask, update_dq
+from acstools.satdet import make_mask
 import shutil
+from collections import OrderedDict
 from StringIO import StringIO
 #from slackclient import SlackClient as sc
 import ephem  
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 import ctypes
+import ctypes.util
+import fcntl
+import threading
+import select
+import struct
+import sqlite3
+import json
+import hashlib
+import bisect
+import gzip
+import io
 
 __version__ = '0.7.2'
 
@@ -79,12 +96,14 @@ def run_blackbox (telescope=None, mode=None, date=None, read_path=None, slack=No
     global lock
     lock = Lock()
 
-    # start queue that will contain entries containing the reference
-    # image header OBJECT and FILTER values, so that duplicate
-    # reference building for the same object and filter by different
-    # threads can be avoided
-    global ref_ID_filt
-    ref_ID_filt = Queue()
+    # calibration files shared between the processes are stored in a
+    # subdirectory for this telescope of [set_blackbox.shm_dir]; any
+    # files left from a previous run are removed now and at the end
+    # of this run
+    global shared_cal_path
+    shared_cal_path = '{}/{}'.format(set_blackbox.shm_dir, telescope)
+    if set_blackbox.shared_cal:
+        clean_shared_cal()
 
     if mode == 'day':
 
@@ -106,39 +125,46 @@ def run_blackbox (telescope=None, mode=None, date=None, read_path=None, slack=No
         else:
                 
             try:
-                pool = Pool(set_blackbox.nproc)
-                results = [pool.apply_async(blackbox_reduce, (filename, telescope,
-                                                              mode, read_path))
-                           for filename in filenames]
-                output = [p.get() for p in results]
-                q.put(logger.info(output))
+                if set_blackbox.affinity:
+                    pool = AffinityPool(set_blackbox.nproc)
+                else:
+                    pool = Pool(set_blackbox.nproc)
+                schedule_day(pool, filenames, telescope, mode, read_path)
                 pool.close()
                 pool.join()
             except Exception as e:
                 q.put(logger.info(traceback.format_exc()))
-                q.put(logger.error('exception was raised during [pool.apply_async]: {}'
+                q.put(logger.error('exception was raised during [schedule_day]: {}'
                                    .format(e)))
 
     elif mode == 'night':
         # if in night mode, check if anythin changes in input directory
         # and if there is a new file, feed it to [blackbox_reduce]
 
-        # create queue for submitting jobs
-        queue = Queue()
-        # create pool with given number of processes and queue feeding
-        # into action function
-        pool = Pool(set_blackbox.nproc, action, (queue,))
-
-        # create and setup observer, but do not start just yet
-        observer = Observer()
-        observer.schedule(FileWatcher(queue, telescope, mode, read_path),
-                          read_path, recursive=False)
-
-        # glob any files already there
+        # create pool with given number of processes and the queue
+        # that submits the images to it
+        if set_blackbox.affinity:
+            pool = AffinityPool(set_blackbox.nproc)
+        else:
+            pool = Pool(set_blackbox.nproc)
+        queue = NightQueue(pool, telescope)
+
+        # create the ingestor that puts the new images in [read_path]
+        # on the queue once they are complete, and start watching
+        # before globbing the files already there, so that no images
+        # are missed in between
+        ingestor = Ingestor(queue, telescope, mode, read_path)
+        ingestor.start()
+
+        # glob any files already there; the ones that were modified
+        # very recently may still be written
         filenames = sort_files(read_path, '*fits*')
         # loop through waiting files and add to pool
-        for filename in filenames: 
-            queue.put([filename, telescope, mode, read_path])
+        for filename in filenames:
+            if time.time()-os.path.getmtime(filename) < 10:
+                ingestor.put_stable(filename, wait=False)
+            else:
+                ingestor.put(filename)
 
         # determine time of next sunrise
         obs = ephem.Observer()
@@ -146,29 +172,289 @@ def run_blackbox (telescope=None, mode=None, date=None, read_path=None, slack=No
         obs.long = str(set_zogy.obs_long)
         sunrise = obs.next_rising(ephem.Sun())
 
-        # start observer
-        observer.start()
-
         # keep monitoring [read_path] directory as long as:
         while ephem.now()-sunrise < ephem.hour:
-            time.sleep(1)
+            queue.dispatch()
+            time.sleep(0.1)
 
         # night has finished, but finish queue if not empty yet
-        while not queue.empty:
-            time.sleep(1)
+        ingestor.stop()
+        while queue.dispatch():
+            time.sleep(0.1)
+        pool.close()
+        pool.join()
+        queue.write_state()
+        q.put(logger.info('night queue: {}'.format(queue.state())))
 
         # all done!
         q.put(logger.info('stopping time reached, exiting pipeline.'))
-        observer.stop() #stop observer
-        observer.join() #join observer
+        if set_blackbox.shared_cal:
+            clean_shared_cal()
         logging.shutdown()
         raise SystemExit
 
         
+    if set_blackbox.shared_cal:
+        clean_shared_cal()
+
     if set_zogy.timing:
         log_timing_memory (t0=t_run_blackbox, label='run_blackbox', log=genlog)
 
 
+################################################################################
+
+def schedule_day (pool, filenames, telescope, mode, read_path):
+
+    """Function that reduces the raw images [filenames] in day mode
+       using the processes in [pool], taking into account the
+       dependencies between them: the master bias of an evening date
+       is built once all bias frames of that date are reduced, the
+       master flat of a date and filter once the master bias and all
+       flats of that date and filter are available, and flats and
+       object images are only reduced once the master bias and
+       (for object images) master flat they need are available. Jobs
+       whose dependencies are done run in parallel, with at most
+       [set_blackbox.nproc] jobs submitted at any time, in order of
+       priority: masters first, followed by the bias, flat and object
+       frames that are needed to make them.
+
+       Object images are grouped by field and filter; if the
+       reference image of a group does not exist yet, the image
+       selected by [select_ref] is reduced first to make the
+       reference, and the other images of the group, which need the
+       reference for the image subtraction, only afterwards.
+
+    """
+
+    # job priorities; lowest is submitted first
+    priority = {'mbias': 0, 'bias': 1, 'mflat': 2, 'flat': 3, 'ref': 4,
+                'object': 5}
+
+    # dictionaries with job IDs as keys and the function with its
+    # arguments, the job priority and the set of jobs it depends on
+    job_func = {}
+    job_prio = {}
+    job_deps = {}
+    # and the key with which [AffinityPool] routes it
+    job_key = {}
+
+    def add_master (imtype, date_eve, filt):
+        job = (imtype, date_eve, filt)
+        if job not in job_func:
+            job_func[job] = (master_job, (telescope, date_eve, filt, imtype))
+            job_key[job] = ('flat', filt) if imtype == 'flat' else None
+            job_prio[job] = (priority['m{}'.format(imtype)], len(job_prio))
+            job_deps[job] = set()
+            if imtype == 'flat':
+                job_deps[job].add(add_master('bias', date_eve, None))
+        return job
+
+    # object images grouped by field and filter, with tuples of job ID
+    # and header
+    obj_groups = {}
+
+    for filename, header in zip(filenames, scan_headers(filenames)):
+
+        # image type matched in the same way as in [sort_files]
+        imgtype = header['IMAGETYP'].lower()
+        imgtypes = [imtype for imtype in ['bias', 'flat', 'object']
+                    if imtype in imgtype]
+        if not imgtypes:
+            continue
+        imgtype = imgtypes[0]
+
+        __, date_eve = get_path(telescope, header['DATE-OBS'], 'write')
+        filt = header['FILTER']
+
+        job = ('frame', filename)
+        job_func[job] = (blackbox_reduce, (filename, telescope, mode, read_path))
+        job_key[job] = affinity_key(header)
+        job_prio[job] = (priority[imgtype], len(job_prio))
+        job_deps[job] = set()
+
+        # frames that the masters depend on, and masters that the
+        # frames depend on
+        if imgtype == 'bias':
+            job_deps[add_master('bias', date_eve, None)].add(job)
+        elif imgtype == 'flat':
+            job_deps[job].add(add_master('bias', date_eve, None))
+            job_deps[add_master('flat', date_eve, filt)].add(job)
+        elif imgtype == 'object':
+            job_deps[job].add(add_master('bias', date_eve, None))
+            job_deps[job].add(add_master('flat', date_eve, filt))
+            obj_groups.setdefault((get_obj(header), filt), []).append((job, header))
+
+
+    # plan the reference images that do not exist yet
+    for (obj, filt), group in obj_groups.items():
+        ref_fits_out = '{}/{}/{}/{}_{}_red.fits'.format(set_blackbox.ref_dir, telescope,
+                                                       obj, telescope, filt)
+        if os.path.isfile(ref_fits_out):
+            continue
+
+        job_ref = select_ref(group)
+        job_prio[job_ref] = (priority['ref'], job_prio[job_ref][1])
+        for job, header in group:
+            if job != job_ref:
+                job_deps[job].add(job_ref)
+
+        q.put(logger.info('reference for OBJECT: {}, FILTER: {} will be made from {}'
+                          .format(obj, filt, job_ref[1])))
+
+
+    q.put(logger.info('scheduling {} jobs for {} images'
+                      .format(len(job_func), len(filenames))))
+
+    jobs_todo = set(job_func.keys())
+    jobs_done = set()
+    jobs_running = {}
+    # jobs that finished, added by the callbacks of the pool, which
+    # also set [job_finished]
+    jobs_finished = []
+    job_finished = threading.Event()
+    def finish (job):
+        jobs_finished.append(job)
+        job_finished.set()
+    # time at which the jobs became ready to run
+    job_t_ready = {}
+    while jobs_todo or jobs_running:
+
+        # submit jobs whose dependencies are done, in order of
+        # priority, keeping at most [set_blackbox.nproc] jobs in flight;
+        # with [AffinityPool], the highest-priority job whose worker
+        # is idle is submitted (see [AffinityPool.select])
+        jobs_ready = sorted([job for job in jobs_todo
+                             if job_deps[job] <= jobs_done],
+                            key=lambda job: job_prio[job])
+        for job in jobs_ready:
+            job_t_ready.setdefault(job, time.time())
+        nfree = set_blackbox.nproc - len(jobs_running)
+        while nfree > 0 and jobs_ready:
+            if set_blackbox.affinity:
+                n = pool.select([(job_key[job], job_t_ready[job]) for job in jobs_ready])
+                if n is None:
+                    break
+            else:
+                n = 0
+            job = jobs_ready.pop(n)
+            func, args = job_func[job]
+            callback = lambda result, job=job: finish(job)
+            if set_blackbox.affinity:
+                jobs_running[job] = pool.apply_async(func, args, key=job_key[job],
+                                                     t_ready=job_t_ready[job],
+                                                     callback=callback,
+                                                     error_callback=callback)
+            else:
+                jobs_running[job] = pool.apply_async(func, args, callback=callback,
+                                                     error_callback=callback)
+            jobs_todo.remove(job)
+            nfree -= 1
+
+        if not jobs_running:
+            # can only happen if jobs depend on each other
+            q.put(logger.error('jobs with unresolvable dependencies: {}'
+                               .format(sorted(jobs_todo))))
+            break
+
+        # wait for running jobs to finish; with [AffinityPool], wake
+        # up at the latest when a job that could not be submitted to
+        # its busy worker has waited long enough to be stolen
+        timeout = None
+        if set_blackbox.affinity and nfree > 0 and jobs_ready:
+            t_steal = (min([job_t_ready[job] for job in jobs_ready]) +
+                       set_blackbox.affinity_steal_wait)
+            timeout = max(t_steal - time.time(), 0)
+        job_finished.wait(timeout)
+        job_finished.clear()
+        finished = jobs_finished[:]
+        del jobs_finished[:]
+
+        # jobs that failed are also considered done, as their
+        # dependent jobs can still proceed (e.g. using the closest
+        # master available)
+        for job in finished:
+            try:
+                jobs_running.pop(job).get()
+            except Exception as e:
+                q.put(logger.info(traceback.format_exc()))
+                q.put(logger.error('exception was raised during job {}: {}'
+                                   .format(job, e)))
+            jobs_done.add(job)
+
+
+################################################################################
+
+def select_ref (group):
+
+    """Function that returns the job ID of the object image that is
+       selected to make the reference image from [group], a list of
+       tuples of job ID and header of the images of a single field
+       and filter, according to [set_blackbox.ref_select]: 'first'
+       (earliest DATE-OBS), 'exptime' (longest EXPTIME) or 'airmass'
+       (lowest AIRMASS). If the header keyword needed is not present
+       in all headers, the first image is selected.
+
+    """
+
+    group = sorted(group, key=lambda job_header: job_header[1]['DATE-OBS'])
+
+    key = {'exptime': 'EXPTIME', 'airmass': 'AIRMASS'}.get(set_blackbox.ref_select)
+    if key is None or not all([key in header for job, header in group]):
+        return group[0][0]
+
+    if key == 'EXPTIME':
+        # longest exposure time
+        return max(group, key=lambda job_header: job_header[1][key])[0]
+    else:
+        # lowest airmass
+        return min(group, key=lambda job_header: job_header[1][key])[0]
+
+
+################################################################################
+
+def get_obj (header):
+
+    """Function that returns the field name from the header keyword
+       FIELD_ID if present, or else from OBJECT, with any characters
+       other than alphanumeric ones, '-' and '_' removed."""
+
+    # if 'FIELD_ID' keyword is present in the header, which
+    # is the case for the test
+    if 'FIELD_ID' in header:
+        obj = header['FIELD_ID']
+    else:
+        obj = header['OBJECT']
+
+    return ''.join(e for e in obj if e.isalnum() or e=='-' or e=='_')
+
+
+################################################################################
+
+def master_job (telescope, date_eve, filt, imtype):
+
+    """Function that builds the master bias or flat for [date_eve]
+       (and [filt] in case of the flat) if it does not exist yet; run
+       as a job by [schedule_day]."""
+
+    write_path, __ = get_path(telescope, date_eve, 'write')
+    path = '{}/{}'.format(write_path, imtype)
+    make_dir (path)
+
+    fits_master = get_fits_master(path, date_eve, filt, imtype)
+    global log
+    log = create_log ('{}.log'.format(fits_master.split('.fits')[0]))
+
+    # no lock is needed, as [schedule_day] runs a single job for each
+    # master and the images using it are only reduced afterwards
+    if os.path.isfile(fits_master):
+        log.info('master {} already exists'.format(fits_master))
+    else:
+        log.info('building master {}'.format(fits_master))
+        fits_master = build_master(path, date_eve, filt, imtype)
+
+    return fits_master
+
+
 ################################################################################
     
 def blackbox_reduce (filename, telescope, mode, read_path):
@@ -183,17 +469,12 @@ def blackbox_reduce (filename, telescope, mode, read_path):
         t_blackbox_reduce = time.time()
 
     # for night mode, the image needs to be moved out of the directory
-    # that is being monitored immediately, for one thing because it
-    # will first get unzipped, and the unzipped file will be
-    # recognized by the watchdog as a new file, which is a problem
+    # that is being monitored immediately, so that any new files
+    # related to it are not recognized as new images
     if mode == 'night':
 
-        if '.fz' in filename:
-            ext = 1
-        else:
-            ext = 0
         # just read the header for the moment
-        header = read_hdulist(filename, ext_header=ext)
+        header = read_header_raw(filename)
         # and determine the raw data path (which is not necessarily the
         # same as the input [read_path])
         raw_path, __ = get_path(telescope, header['DATE-OBS'], 'read')
@@ -217,9 +498,8 @@ def blackbox_reduce (filename, telescope, mode, read_path):
         filename = dest
 
 
-    # read in image data and header; unzip image first if needed
-    data, header = read_hdulist(unzip(filename), ext_data=0, ext_header=0,
-                                dtype='float32')
+    # read in image data and header, decompressing it in memory if needed
+    data, header = read_fits_mem(filename, dtype='float32')
 
     # extend the header with some useful keywords
     result = set_header(header, filename)
@@ -252,13 +532,7 @@ def blackbox_reduce (filename, telescope, mode, read_path):
         fits_out = fits_out.replace('.fits', '_{}.fits'.format(filt))
 
     if imgtype == 'object':
-        # if 'FIELD_ID' keyword is present in the header, which
-        # is the case for the test
-        if 'FIELD_ID' in header:
-            obj = header['FIELD_ID']
-        else:
-            obj = header['OBJECT']
-        obj = ''.join(e for e in obj if e.isalnum() or e=='-' or e=='_')
+        obj = get_obj(header)
         fits_out = fits_out.replace('.fits', '_red.fits')
         fits_out_mask = fits_out.replace('_red.fits', '_mask.fits')
 
@@ -277,7 +551,7 @@ def blackbox_reduce (filename, telescope, mode, read_path):
                 return
 
             
-    if os.path.isfile(fits_out):
+    if isfile_fz(fits_out):
         q.put(logger.warn ('corresponding reduced image {} already exist; skipping'
                            .format(fits_out.split('/')[-1])))
         return
@@ -321,24 +595,55 @@ def blackbox_reduce (filename, telescope, mode, read_path):
         log.info('ref_path: {}'.format(ref_path))
     
 
+    # fused reduction
+    ##################
+    # if [set_blackbox.fused_reduce] is True, object images are
+    # corrected for the gain, crosstalk, overscan, master bias and
+    # master flat in a single pass, provided the master bias and flat
+    # are already available; if not, or if the fused reduction
+    # fails, the individual steps below are performed instead
+    fused_processed = False
+    if set_blackbox.fused_reduce and imgtype == 'object':
+        fits_mbias = get_fits_master(bias_path, date_eve, filt, 'bias')
+        fits_mflat = get_fits_master(flat_path, date_eve, filt, 'flat')
+        if os.path.isfile(fits_mbias) and os.path.isfile(fits_mflat):
+            try:
+                log.info('reducing the image in a single fused pass')
+                data, data_mask, header_mask = reduce_fused(
+                    data, header, fits_mbias, fits_mflat, date_eve, filt)
+            except Exception as e:
+                q.put(logger.info(traceback.format_exc()))
+                q.put(logger.error('exception was raised during [reduce_fused]: {}'
+                                   .format(e)))
+                log.info(traceback.format_exc())
+                log.error('exception was raised during [reduce_fused]: {}'.format(e))
+            else:
+                fused_processed = True
+        else:
+            log.info('master bias and/or flat not yet available; performing '
+                     'the reduction steps separately')
+
+
     # gain correction
     #################
-    try:
-        log.info('correcting for the gain')
-        gain_processed = False
-        data = gain_corr(data, header)
-    except Exception as e:
-        q.put(logger.info(traceback.format_exc()))
-        q.put(logger.error('exception was raised during [gain_corr]: {}'.format(e)))
-        log.info(traceback.format_exc())
-        log.error('exception was raised during [gain_corr]: {}'.format(e))
-    else:
-        gain_processed = True
+    gain_processed = fused_processed
+    if not fused_processed:
+        try:
+            log.info('correcting for the gain')
+            data = gain_corr(data, header)
+        except Exception as e:
+            q.put(logger.info(traceback.format_exc()))
+            q.put(logger.error('exception was raised during [gain_corr]: {}'.format(e)))
+            log.info(traceback.format_exc())
+            log.error('exception was raised during [gain_corr]: {}'.format(e))
+        else:
+            gain_processed = True
+    if gain_processed:
         header['GAIN'] = (1, '[e-/ADU] effective gain all channels')
     # following line needs to be outside if/else statements
     header['GAIN-P'] = (gain_processed, 'corrected for gain?')
 
-    if set_zogy.display:
+    if set_zogy.display and not fused_processed:
         ds9_arrays(gain_cor=data)
 
     #args_in = [data, header}
@@ -353,22 +658,23 @@ def blackbox_reduce (filename, telescope, mode, read_path):
     ######################
     if imgtype == 'object':
         # not needed for biases or flats
-        try: 
-            log.info('correcting for the crosstalk')
-            xtalk_processed = False
-            data_old = xtalk_corr (data, set_blackbox.crosstalk_file)
-        except Exception as e:
-            q.put(logger.info(traceback.format_exc()))
-            q.put(log.error('exception was raised during [xtalk_corr]: {}'.format(e)))
-            log.info(traceback.format_exc())
-            log.error('exception was raised during [xtalk_corr]: {}'.format(e))
-        else:
-            xtalk_processed = True
+        xtalk_processed = fused_processed
+        if not fused_processed:
+            try: 
+                log.info('correcting for the crosstalk')
+                data_old = xtalk_corr (data, set_blackbox.crosstalk_file)
+            except Exception as e:
+                q.put(logger.info(traceback.format_exc()))
+                q.put(log.error('exception was raised during [xtalk_corr]: {}'.format(e)))
+                log.info(traceback.format_exc())
+                log.error('exception was raised during [xtalk_corr]: {}'.format(e))
+            else:
+                xtalk_processed = True
         # following line needs to be outside if/else statements
         header['XTALK-P'] = (xtalk_processed, 'corrected for crosstalk?')
-        header['XTALK-F'] = (set_blackbox.crosstalk_file.strip('/')[-1], 'name crosstalk coefficients file')
+        header['XTALK-F'] = (set_blackbox.crosstalk_file.split('/')[-1], 'name crosstalk coefficients file')
 
-        if set_zogy.display:
+        if set_zogy.display and not fused_processed:
             ds9_arrays(Xtalk_cor=data)
             
             
@@ -380,73 +686,75 @@ def blackbox_reduce (filename, telescope, mode, read_path):
 
     # overscan correction
     #####################
-    try: 
-        log.info('correcting for the overscan')
-        os_processed = False
-        data = os_corr(data, header)
-    except Exception as e:
-        q.put(logger.info(traceback.format_exc()))
-        q.put(logger.error('exception was raised during [os_corr]: {}'.format(e)))
-        log.info(traceback.format_exc())
-        log.error('exception was raised during [os_corr]: {}'.format(e))
-    else:
-        os_processed = True
+    os_processed = fused_processed
+    if not fused_processed:
+        try: 
+            log.info('correcting for the overscan')
+            data = os_corr(data, header)
+        except Exception as e:
+            q.put(logger.info(traceback.format_exc()))
+            q.put(logger.error('exception was raised during [os_corr]: {}'.format(e)))
+            log.info(traceback.format_exc())
+            log.error('exception was raised during [os_corr]: {}'.format(e))
+        else:
+            os_processed = True
     # following line needs to be outside if/else statements
     header['OS-P'] = (os_processed, 'corrected for overscan?')
 
 
-    if set_zogy.display:
+    if set_zogy.display and not fused_processed:
         ds9_arrays(os_cor=data)
 
 
     # if IMAGETYP=bias, write [data] to fits and leave [blackbox_reduce]
     if imgtype == 'bias':
-        fits.writeto(fits_out, data.astype('float32'), header, overwrite=True)
+        write_fits(fits_out, data.astype('float32'), header)
         return
         
 
     # master bias creation and subtraction
     ######################################
-    try: 
-        log.info('subtracting the master bias')
-        mbias_processed = False
-        lock.acquire()
-        data = master_corr(data, header, None, bias_path, date_eve, filt, 'bias')
-        lock.release()
-    except Exception as e:
-        q.put(logger.info(traceback.format_exc()))
-        q.put(logger.error('exception was raised during [mbias_corr]: {}'.format(e)))
-        log.info(traceback.format_exc())
-        log.error('exception was raised during [mbias_corr]: {}'.format(e))
-    else:
-        mbias_processed = True
+    mbias_processed = fused_processed
+    if not fused_processed:
+        try: 
+            log.info('subtracting the master bias')
+            data = master_corr(data, header, None, bias_path, date_eve, filt, 'bias')
+        except Exception as e:
+            q.put(logger.info(traceback.format_exc()))
+            q.put(logger.error('exception was raised during [master_corr]: {}'.format(e)))
+            log.info(traceback.format_exc())
+            log.error('exception was raised during [master_corr]: {}'.format(e))
+        else:
+            mbias_processed = True
     # following line needs to be outside if/else statements
     header['MBIAS-P'] = (mbias_processed, 'corrected for master bias?')
 
     
     # if IMAGETYP=flat, write [data] to fits and leave [blackbox_reduce]
     if imgtype == 'flat':
-        fits.writeto(fits_out, data.astype('float32'), header, overwrite=True)
+        write_fits(fits_out, data.astype('float32'), header)
         return
 
-    if set_zogy.display:
+    if set_zogy.display and not fused_processed:
         ds9_arrays(bias_sub=data)
 
         
     # create initial mask array
     ###########################
     if imgtype == 'object':
-        try: 
-            log.info('preparing the initial mask')
-            mask_processed = False
-            data_mask, header_mask = mask_init (data, header)
-        except Exception as e:
-            q.put(logger.info(traceback.format_exc()))
-            q.put(logger.error('exception was raised during [mask_init]: {}'.format(e)))
-            log.info(traceback.format_exc())
-            log.error('exception was raised during [mask_init]: {}'.format(e))
-        else:
-            mask_processed = True
+        mask_processed = fused_processed
+        if not fused_processed:
+            try: 
+                log.info('preparing the initial mask')
+                data_mask, header_mask = mask_init (data, header, filt=filt,
+                                                    date_eve=date_eve)
+            except Exception as e:
+                q.put(logger.info(traceback.format_exc()))
+                q.put(logger.error('exception was raised during [mask_init]: {}'.format(e)))
+                log.info(traceback.format_exc())
+                log.error('exception was raised during [mask_init]: {}'.format(e))
+            else:
+                mask_processed = True
         # following line needs to be outside if/else statements
         header['MASK-P'] = (mask_processed, 'mask image created?')
 
@@ -457,19 +765,18 @@ def blackbox_reduce (filename, telescope, mode, read_path):
 
     # master flat creation and correction
     #####################################
-    try: 
-        log.info('flatfielding')
-        mflat_processed = False
-        lock.acquire()
-        data = master_corr(data, header, data_mask, flat_path, date_eve, filt, 'flat')
-        lock.release()
-    except Exception as e:
-        q.put(logger.info(traceback.format_exc()))
-        q.put(logger.error('exception was raised during [mflat_corr]: {}'.format(e)))
-        log.info(traceback.format_exc())
-        log.error('exception was raised during [mflat_corr]: {}'.format(e))
-    else:
-        mflat_processed = True
+    mflat_processed = fused_processed
+    if not fused_processed:
+        try: 
+            log.info('flatfielding')
+            data = master_corr(data, header, data_mask, flat_path, date_eve, filt, 'flat')
+        except Exception as e:
+            q.put(logger.info(traceback.format_exc()))
+            q.put(logger.error('exception was raised during [master_corr]: {}'.format(e)))
+            log.info(traceback.format_exc())
+            log.error('exception was raised during [master_corr]: {}'.format(e))
+        else:
+            mflat_processed = True
     # following line needs to be outside if/else statements
     header['MFLAT-P'] = (mflat_processed, 'corrected for master flat?')
 
@@ -531,127 +838,134 @@ def blackbox_reduce (filename, telescope, mode, read_path):
     log.info('writing reduced image and mask to {}'.format(tmp_path))
     new_fits = '{}/{}'.format(tmp_path, fits_out.split('/')[-1]) 
     new_fits_mask = new_fits.replace('_red.fits', '_mask.fits')
-    fits.writeto(new_fits, data.astype('float32'), header, overwrite=True)
-    fits.writeto(new_fits_mask, data_mask.astype('uint8'), header_mask,
-                 overwrite=True)
+    # convert in place if the arrays already have the output type
+    data = data.astype('float32', copy=False)
+    data_mask = data_mask.astype('uint8', copy=False)
+    fits.writeto(new_fits, data, header, overwrite=True)
+    fits.writeto(new_fits_mask, data_mask, header_mask, overwrite=True)
+
+    # the files are still needed by the external programs that ZOGY
+    # runs, such as SExtractor, but ZOGY itself can read them from
+    # memory
+    handoff.clear()
+    if set_blackbox.zogy_handoff:
+        handoff_add(new_fits, data, header)
+        handoff_add(new_fits_mask, data_mask, header_mask)
     
     if set_zogy.display:
         ds9_arrays(mask=data_mask)
         print (header['NSATS']) #DP: added brackets
 
+    # the image and mask are not needed anymore in this function, so
+    # drop the references to them; only [handoff] keeps them in
+    # memory for ZOGY, if at all
+    del data, data_mask
+
         
     # run zogy's [optimal_subtraction]
     ##################################
+    write_pending = False
     try: 
         log.info ('running optimal image subtraction')
         zogy_processed = False
         
-        # using the function [check_ref], check if the reference image
-        # with the same header OBJECT and FILTER as the currently
-        # processed image happens to be made right now, using a lock
-        lock.acquire()
-
         # change to [tmp_path]; only necessary if making plots as
         # PSFEx is producing its diagnostic output fits and plots in
         # the current directory
         if set_zogy.make_plots:
             os.chdir(tmp_path)
-        
-        # this extra second is to provide a head start to the process
-        # that is supposed to be making the reference image; that
-        # process needs to add its OBJECT and FILTER to the queue
-        # [ref_ID_filt] before the next process is calling [check_ref]
-        time.sleep(1)
-        ref_being_made = check_ref(ref_ID_filt, (obj, filt))
-        log.info('is reference for same OBJECT and FILTER being_made now?: {}'
-                 .format(ref_being_made))
-        lock.release()
-        
-        if ref_being_made:
-            # if reference in this filter is being made, let the affected
-            # process wait until reference building is done
-            if ref_being_made:
-                while check_ref(ref_ID_filt, (obj, filt)):
-                    log.info ('waiting for reference job to be finished for '+
-                              'OBJECT: {}, FILTER: {}'.format(obj, filt))
-                    time.sleep(5)
-                log.info ('done waiting for reference job to be finished for '+
-                          'OBJECT: {}, FILTER: {}'.format(obj, filt))
-                    
-        # lock the following block to allow only a single process to
-        # execute the reference image creation
-        #lock.acquire()
-
-        # if ref image has not yet been processed:
-        if not os.path.isfile(ref_fits_out):
-#            refjob = True
-#        else:
-#            refjob = False
-#        if refjob:
-            
-            # update [ref_ID_filt] queue with a tuple with this OBJECT
-            # and FILTER combination
-            ref_ID_filt.put((obj, filt))
 
-            log.info('making ref image')
+        # claim the reference image with the same header OBJECT and
+        # FILTER as the currently processed image; if another process
+        # is making it right now, this waits until that process is
+        # done (or has died, in which case the reference is made here)
+        log.info('claiming reference for OBJECT: {}, FILTER: {}'.format(obj, filt))
+        f_ref_lock = lock_ref(ref_path, telescope, filt)
+        log.info('claimed reference for OBJECT: {}, FILTER: {}'.format(obj, filt))
+
+        # let ZOGY read through [read_hdulist_mem] during this
+        # subtraction only; the original is restored below
+        if set_blackbox.zogy_handoff or set_blackbox.ref_cache_mb > 0:
+            zogy.read_hdulist = read_hdulist_mem
 
-            log.info('new_fits: {}'.format(new_fits))
-            log.info('new_fits_mask: {}'.format(new_fits_mask))
+        try:
+
+            # if ref image has not yet been processed:
+            if not os.path.isfile(ref_fits_out):
+
+                log.info('making ref image')
+
+                log.info('new_fits: {}'.format(new_fits))
+                log.info('new_fits_mask: {}'.format(new_fits_mask))
 
-            result = optimal_subtraction(ref_fits=new_fits,
-                                         ref_fits_mask=new_fits_mask,
-                                         set_file='Settings.set_zogy',
-                                         log=log, verbose=None,
-                                         nthread=set_blackbox.nthread)
+                result = optimal_subtraction(ref_fits=new_fits,
+                                             ref_fits_mask=new_fits_mask,
+                                             set_file='Settings.set_zogy',
+                                             log=log, verbose=None,
+                                             nthread=set_blackbox.nthread)
 
-            if set_zogy.timing:
-                log_timing_memory (t0=t_blackbox_reduce, label='blackbox_reduce', log=log)
+                if set_zogy.timing:
+                    log_timing_memory (t0=t_blackbox_reduce, label='blackbox_reduce', log=log)
                 
-            # copy selected output files to reference directory
-            ref_base = ref_fits_out.split('_red.fits')[0]
-            tmp_base = new_fits.split('_red.fits')[0]
-            result = copy_files2keep(tmp_base, ref_base, set_blackbox.ref_2keep)
-
-            # now that reference is built, remove this reference ID
-            # and filter combination from the [ref_ID_filt] queue
-            lock.acquire()
-            result = check_ref(ref_ID_filt, (obj, filt), method='remove')
-            lock.release()
+                # copy selected output files to reference directory
+                ref_base = ref_fits_out.split('_red.fits')[0]
+                tmp_base = new_fits.split('_red.fits')[0]
+                result = copy_files2keep(tmp_base, ref_base, set_blackbox.ref_2keep)
+
+                # now that reference is built, release it so that any
+                # processes waiting for it can continue
+                f_ref_lock.close()
             
-        else:
+            else:
 
-         #lock.release()        
-#        if not refjob:
+                # reference already exists, so release it immediately
+                f_ref_lock.close()
             
-            # make symbolic links to all files in the reference
-            # directory with the same filter
-            ref_files = glob.glob('{}/{}*{}*'.format(ref_path, telescope, filt))
-            for ref_file in ref_files:
-                os.symlink(ref_file, '{}/{}'.format(tmp_path, ref_file.split('/')[-1]))
-
-            ref_fits = '{}/{}'.format(tmp_path, ref_fits_out.split('/')[-1])
-            ref_fits_mask = '{}/{}'.format(tmp_path, ref_fits_out_mask.split('/')[-1])
+                # make symbolic links to all files in the reference
+                # directory with the same filter
+                ref_files = glob.glob('{}/{}*{}*'.format(ref_path, telescope, filt))
+                for ref_file in ref_files:
+                    os.symlink(ref_file, '{}/{}'.format(tmp_path, ref_file.split('/')[-1]))
+
+                ref_fits = '{}/{}'.format(tmp_path, ref_fits_out.split('/')[-1])
+                ref_fits_mask = '{}/{}'.format(tmp_path, ref_fits_out_mask.split('/')[-1])
                         
-            log.info('new_fits: {}'.format(new_fits))
-            log.info('new_fits_mask: {}'.format(new_fits_mask))
-            log.info('ref_fits: {}'.format(ref_fits))
-            log.info('ref_fits_mask: {}'.format(ref_fits_mask))
+                log.info('new_fits: {}'.format(new_fits))
+                log.info('new_fits_mask: {}'.format(new_fits_mask))
+                log.info('ref_fits: {}'.format(ref_fits))
+                log.info('ref_fits_mask: {}'.format(ref_fits_mask))
         
-            result = optimal_subtraction(new_fits=new_fits,
-                                         ref_fits=ref_fits,
-                                         new_fits_mask=new_fits_mask,
-                                         ref_fits_mask=ref_fits_mask,
-                                         set_file='Settings.set_zogy',
-                                         log=log, verbose=None,
-                                         nthread=set_blackbox.nthread)
-
-            if set_zogy.timing:
-                log_timing_memory (t0=t_blackbox_reduce, label='blackbox_reduce', log=log)
-
-            # copy selected output files to new directory
-            new_base = fits_out.split('_red.fits')[0]
-            tmp_base = new_fits.split('_red.fits')[0]
-            result = copy_files2keep(tmp_base, new_base, set_blackbox.new_2keep)
+                result = optimal_subtraction(new_fits=new_fits,
+                                             ref_fits=ref_fits,
+                                             new_fits_mask=new_fits_mask,
+                                             ref_fits_mask=ref_fits_mask,
+                                             set_file='Settings.set_zogy',
+                                             log=log, verbose=None,
+                                             nthread=set_blackbox.nthread)
+
+                if set_zogy.timing:
+                    log_timing_memory (t0=t_blackbox_reduce, label='blackbox_reduce', log=log)
+
+                # copy selected output files to new directory; in
+                # handoff mode, this is done in the background, after
+                # which [tmp_path] is removed
+                new_base = fits_out.split('_red.fits')[0]
+                tmp_base = new_fits.split('_red.fits')[0]
+                if set_blackbox.zogy_handoff:
+                    write_async(copy_files2keep, (tmp_base, new_base,
+                                                  set_blackbox.new_2keep, True),
+                                logfile, log2keep='{}_red.log'.format(new_base),
+                                tmp_path=tmp_path)
+                    write_pending = True
+                else:
+                    result = copy_files2keep(tmp_base, new_base, set_blackbox.new_2keep,
+                                             compress=True)
+
+        finally:
+            # also release the reference if an exception was raised
+            f_ref_lock.close()
+            handoff.clear()
+            zogy.read_hdulist = read_hdulist_zogy
 
 
         lock.acquire()
@@ -659,7 +973,8 @@ def blackbox_reduce (filename, telescope, mode, read_path):
         if set_zogy.make_plots:
             os.chdir(set_blackbox.run_dir)
         # and delete [tmp_path] if [set_blackbox.keep_tmp] not True
-        if not set_blackbox.keep_tmp and os.path.isdir(tmp_path):
+        if (not set_blackbox.keep_tmp and not write_pending and
+            os.path.isdir(tmp_path)):
             shutil.rmtree(tmp_path)
         lock.release()
         
@@ -676,26 +991,25 @@ def blackbox_reduce (filename, telescope, mode, read_path):
 
 ################################################################################
 
-def check_ref (queue_ref, obj_filt, method=None):
+def lock_ref (ref_path, telescope, filt):
 
-    mycopy = []
-    ref_being_made = False
-    while True:
-        try:
-            elem = queue_ref.get(False)
-        except:
-            break
-        else:
-            mycopy.append(elem)
+    """Function that claims the reference image of [telescope] and
+       filter [filt] in [ref_path] by acquiring an exclusive lock on
+       its lock file, which is returned as an open file. If another
+       process holds the lock, i.e. it is making that reference image
+       right now, this function blocks until the lock is released by
+       closing the file. The lock is also released by the operating
+       system if the process holding it dies, so that the reference
+       can be claimed by another process.
 
-    for elem in mycopy:
-        if elem == obj_filt:
-            ref_being_made = True
-            if method != 'remove':
-                queue_ref.put(elem)
-                time.sleep(0.1)
+    """
+
+    # hidden file, so that it is not picked up by the glob of the
+    # reference files in [blackbox_reduce]
+    f_lock = open('{}/.{}_{}_ref.lock'.format(ref_path, telescope, filt), 'w')
+    fcntl.flock(f_lock, fcntl.LOCK_EX)
 
-    return ref_being_made
+    return f_lock
 
                 
 ################################################################################
@@ -776,13 +1090,22 @@ def make_dir(path, empty=False):
 
 ################################################################################
 
-def copy_files2keep (tmp_base, dest_base, ext2keep):
+def copy_files2keep (tmp_base, dest_base, ext2keep, compress=False, log=None):
 
     """Function to copy files with base name [tmp_base] and extensions
     [ext2keep] to files with base name [dest_base] with the same
-    extensions. The base names should include the full path.
+    extensions. The base names should include the full path. If
+    [compress] is True, the images with extensions in
+    [set_blackbox.compress_2keep] are written tile-compressed with
+    [write_fits] instead, divided over [set_blackbox.compress_nthread]
+    threads. Messages are logged to [log], or if it is None, to the
+    root logger.
     """
     
+    if log is None:
+        log = logging.getLogger()
+
+    files2compress = []
     # list of all files starting with [tmp_base]
     tmpfiles = glob.glob('{}*'.format(tmp_base))
     # loop this list
@@ -796,65 +1119,216 @@ def copy_files2keep (tmp_base, dest_base, ext2keep):
                 # if so, and the source and destination names are not
                 # identical, go ahead and copy
                 if tmpfile != destfile:
-                    log.info('copying {} to {}'.format(tmpfile, destfile))
-                    shutil.copyfile(tmpfile, destfile)
+                    if (compress and set_blackbox.compress_output and
+                        ext in set_blackbox.compress_2keep):
+                        files2compress.append((tmpfile, destfile))
+                    else:
+                        log.info('copying {} to {}'.format(tmpfile, destfile))
+                        shutil.copyfile(tmpfile, destfile)
+
+    def compress_file (files):
+        tmpfile, destfile = files
+        log.info('compressing {} to {}.fz'.format(tmpfile, destfile))
+        data, header = read_hdulist(tmpfile, ext_data=0, ext_header=0)
+        write_fits(destfile, data, header)
+
+    nthread = min(set_blackbox.compress_nthread, len(files2compress))
+    if nthread > 1:
+        pool = ThreadPool(nthread)
+        pool.map(compress_file, files2compress)
+        pool.close()
+        pool.join()
+    else:
+        for files in files2compress:
+            compress_file(files)
 
     return
 
 
+################################################################################
+
+def detsat_array (image, sigma=2.0, low_thresh=0.1, h_thresh=0.5,
+                  small_edge=60, line_len=200, line_gap=75,
+                  percentile=(4.5, 93.0), buf=200):
+
+    """Function that finds satellite trails in [image] with a
+       probabilistic Hough transform of its edges, and returns the
+       end points of the trail segments in the format [[[x0, y0], [x1,
+       y1]], ...], or an empty array if no trail crosses the image.
+       This is acstools' [detsat] (version 3.8) for a single image,
+       without the plotting and multiprocessing; it takes an array as
+       [detsat] only accepts file names. The parameters are the same
+       as those of [detsat].
+
+    """
+
+    # rescale the image; anything below zero is set to zero
+    p1, p2 = np.percentile(image, percentile)
+    p1 = max(p1, 0.)
+    image = exposure.rescale_intensity(image, in_range=(p1, p2))
+
+    # get the edges and remove the small objects to reduce the noise
+    immax = np.max(image)
+    edge = canny(image, sigma=sigma, mode='constant',
+                 low_threshold=immax * low_thresh,
+                 high_threshold=immax * h_thresh)
+    try:
+        morphology.remove_small_objects(edge, max_size=small_edge-1,
+                                        connectivity=8, out=edge)
+    except TypeError:
+        # skimage < 0.26
+        morphology.remove_small_objects(edge, min_size=small_edge,
+                                        connectivity=8, out=edge)
+
+    # line segments at angles from 2 to 178 degrees; exactly 0 would
+    # pick up bad columns
+    angle = np.radians(np.arange(2, 178, 0.5, dtype=float))
+    result = np.asarray(probabilistic_hough_line(
+        edge, threshold=210, line_length=line_len, line_gap=line_gap,
+        theta=angle))
+
+    # at least a line is needed
+    if len(result) <= 1:
+        return np.empty(0)
+
+    x0, y0 = result[:,0,0], result[:,0,1]
+    x1, y1 = result[:,1,0], result[:,1,1]
+
+    # angles of the segments rounded to the nearest 5 degrees; those
+    # at multiples of 90 degrees are discarded
+    trail_angle = np.degrees(np.arctan((y1 - y0) / (x1 - x0)))
+    round_angle = (5 * np.round(trail_angle * 0.2)).astype(int)
+    mask = (round_angle % 90 != 0)
+    if not np.any(mask):
+        return np.empty(0)
+    round_angle = round_angle[mask]
+    trail_angle = trail_angle[mask]
+    result = result[mask]
+
+    # only keep the segments at the most common (and if tied, the
+    # smallest) rounded angle
+    angles, counts = np.unique(round_angle, return_counts=True)
+    mask = (round_angle == angles[np.argmax(counts)])
+    trail_angle = trail_angle[mask]
+    result = result[mask]
+
+    # an unreasonable number of segments means it picked up garbage
+    if len(result) > 300:
+        log.warning('too many trail segments ({}) to be correct; rejecting '
+                    'the detection'.format(len(result)))
+        return np.empty(0)
+
+    x0, y0 = result[:,0,0], result[:,0,1]
+    x1, y1 = result[:,1,0], result[:,1,1]
+    mean_angle = np.mean(trail_angle)
+
+    # determine if the trail traversed the image: from top to bottom,
+    # right to left, or between adjacent edges
+    ymax, xmax = image.shape
+    topx, topy = xmax - buf, ymax - buf
+    left = (min(x0) < buf or min(x1) < buf)
+    right = (max(x0) > topx or max(x1) > topx)
+    bottom = (min(y0) < buf or min(y1) < buf)
+    top = (max(y0) > topy or max(y1) > topy)
+    satellite = ((bottom and top) or (left and right) or
+                 ((left and bottom or right and top) and -89 < mean_angle < -1) or
+                 ((left and top or right and bottom) and 1 < mean_angle < 89))
+
+    if satellite:
+        return result
+    else:
+        return np.empty(0)
+
+
 ################################################################################
 
 def sat_detect (data, header, data_mask, header_mask, tmp_path):
 
+    """Function that detects satellite trails in [data] binned by
+       [set_blackbox.sat_bin] and adds them to [data_mask]. The binned
+       image is passed to [detsat_array] and, as an in-memory FITS
+       file, to acstools' mask fitting, so nothing is written to disk. If
+       the image shape is not a multiple of the binning factor, the
+       remaining rows and columns are not used in the detection and
+       take the mask values of the nearest binned pixels.
+
+       If [set_blackbox.sat_prefilter] is True, the image is first
+       screened with [sat_prefilter] and the full detection is only
+       run if its score reaches [set_blackbox.sat_prefilter_thresh];
+       whether it was run is recorded in the header keyword SAT-FULL.
+
+    """
+
     if set_zogy.timing:
         t = time.time()
 
+    if set_blackbox.sat_prefilter:
+        score = sat_prefilter(data, data_mask)
+        sat_full = (score >= set_blackbox.sat_prefilter_thresh)
+        log.info('satellite trail pre-filter score: {:.3f}; running full detection: {}'
+                 .format(score, sat_full))
+        header['SAT-PRE'] = (score, 'satellite trail pre-filter score')
+    else:
+        sat_full = True
+    header['SAT-FULL'] = (sat_full, 'full satellite trail detection performed?')
+
+    if not sat_full:
+        header['NSATS'] = (0, 'number of satellite trails identified')
+        if set_zogy.timing:
+            log_timing_memory (t0=t, label='sat_detect', log=log)
+        return data_mask
+
     #bin data
-    binned_data = data.reshape(np.shape(data)[0]/set_blackbox.sat_bin,set_blackbox.sat_bin,
-                               np.shape(data)[1]/set_blackbox.sat_bin,set_blackbox.sat_bin).sum(3).sum(1)
+    sat_bin = set_blackbox.sat_bin
+    ysize, xsize = np.shape(data)
+    ysize_bin, xsize_bin = ysize // sat_bin, xsize // sat_bin
+    binned_data = (data[0:ysize_bin*sat_bin, 0:xsize_bin*sat_bin]
+                   .reshape(ysize_bin, sat_bin, xsize_bin, sat_bin).sum(3).sum(1))
     satellite_fitting = False
+    mask_binned_tot = np.zeros((ysize_bin, xsize_bin), dtype=bool)
 
     for j in range(3):
-        #write binned data to tmp file
-        fits_binned_mask = ('{}/{}'.format(
-            tmp_path, tmp_path.split('/')[-1].replace('_red','_binned_satmask.fits')))
-        fits.writeto(fits_binned_mask, binned_data, overwrite=True)
         #detect satellite trails
-        results, errors = detsat(fits_binned_mask, chips=[0], n_processes=set_blackbox.nthread,
-                                 buf=40, sigma=3, h_thresh=0.2)
-        #create satellite trail if found
-        trail_coords = results[(fits_binned_mask,0)] 
+        trail_coords = detsat_array(binned_data, buf=40, sigma=3, h_thresh=0.2)
         #continue if satellite trail found
         if len(trail_coords) > 0: 
             trail_segment = trail_coords[0]
             try: 
-                #create satellite trail mask
-                mask_binned = make_mask(fits_binned_mask, 0, trail_segment, sublen=5,
-                                        pad=0, sigma=5, subwidth=5000).astype(np.uint8)
+                #create satellite trail mask from in-memory fits file
+                #of binned data
+                f_binned = io.BytesIO()
+                fits.PrimaryHDU(binned_data).writeto(f_binned)
+                f_binned.seek(0)
+                mask_binned = make_mask(f_binned, 0, trail_segment, sublen=5,
+                                        pad=0, sigma=5, subwidth=5000).astype(bool)
             except ValueError:
                 #if error occurs, add comment
                 print ('Warning: satellite trail found but could not be fitted for file {} and is not included in the mask.'
-                       .format(unique_dir.split('/')[-1]))
+                       .format(tmp_path.split('/')[-1]))
                 break
             satellite_fitting = True
-            binned_data[mask_binned == 1] = np.median(binned_data)
-            fits_old_mask = unique_dir+'/old_mask.fits'
-            if os.path.isfile(fits_old_mask):
-                old_mask = read_hdulist(fits_old_mask, ext_data=0)
-                mask_binned = old_mask+mask_binned
-            fits.writeto(fits_old_mask, mask_binned, overwrite=True)
+            binned_data[mask_binned] = np.median(binned_data)
+            mask_binned_tot |= mask_binned
         else:
             break
     if satellite_fitting == True:
-        #unbin mask
-        mask_sat = np.kron(mask_binned, np.ones((set_blackbox.sat_bin,set_blackbox.sat_bin))).astype(np.uint8)
-        # add pixels affected by cosmic rays to [data_mask]
-        data_mask[mask_sat==1] += set_zogy.mask_value['satellite trail']
+        #unbin mask, by broadcasting the binned mask onto a view of the
+        #full mask with the binned pixels along separate axes
+        mask_sat = np.zeros((ysize, xsize), dtype=bool)
+        mask_sat[0:ysize_bin*sat_bin, 0:xsize_bin*sat_bin].reshape(
+            ysize_bin, sat_bin, xsize_bin, sat_bin)[:] = mask_binned_tot[:,None,:,None]
+        #remaining rows and columns
+        mask_sat[ysize_bin*sat_bin:] = mask_sat[ysize_bin*sat_bin-1]
+        mask_sat[:, xsize_bin*sat_bin:] = mask_sat[:, xsize_bin*sat_bin-1:xsize_bin*sat_bin]
+        # add pixels affected by satellite trails to [data_mask]
+        np.add(data_mask, set_zogy.mask_value['satellite trail'], out=data_mask,
+               where=mask_sat)
         # determining number of trails; 2 pixels are considered from the
-        # same trail also if they are only connected diagonally
+        # same trail also if they are only connected diagonally; this
+        # number is the same for the binned mask
         struct = np.ones((3,3), dtype=bool)
-        __, nsats = ndimage.label(mask_sat, structure=struct)
-        nsatpixels = np.sum(mask_sat)
+        __, nsats = ndimage.label(mask_binned_tot, structure=struct)
+        nsatpixels = np.count_nonzero(mask_sat)
     else:
         nsats = 0
         nsatpixels = 0
@@ -867,6 +1341,46 @@ def sat_detect (data, header, data_mask, header_mask, tmp_path):
     return data_mask
 
         
+################################################################################
+
+def sat_prefilter (data, data_mask):
+
+    """Function that quickly screens [data] for satellite trails, to
+       avoid running the full detection in [sat_detect] on images
+       without them. The image is binned by
+       [set_blackbox.sat_prefilter_bin], and a coarse Hough transform
+       is made of the binned pixels that are more than
+       [set_blackbox.sat_prefilter_nsigma] sigma above the background,
+       excluding binned pixels that contain pixels flagged in
+       [data_mask]. Returns the score: the maximum number of such
+       pixels along a straight line, relative to the smaller
+       dimension of the binned image.
+
+    """
+
+    nbin = set_blackbox.sat_prefilter_bin
+    ysize, xsize = np.shape(data)
+    ysize_bin, xsize_bin = ysize // nbin, xsize // nbin
+    shape_view = (ysize_bin, nbin, xsize_bin, nbin)
+    sec = (slice(0, ysize_bin*nbin), slice(0, xsize_bin*nbin))
+
+    binned_data = data[sec].reshape(shape_view).sum(3).sum(1)
+    binned_mask = data_mask[sec].reshape(shape_view).max(3).max(1)
+
+    # robust background and standard deviation of the unmasked pixels
+    values = binned_data[binned_mask==0]
+    if len(values) == 0:
+        return 0.
+    median = np.median(values)
+    std = 1.4826 * np.median(np.abs(values - median))
+    mask_high = ((binned_data > median + set_blackbox.sat_prefilter_nsigma * std) &
+                 (binned_mask==0))
+
+    accumulator, __, __ = hough_line(mask_high)
+
+    return accumulator.max() / float(min(ysize_bin, xsize_bin))
+
+
 ################################################################################
 
 def cosmics_corr (data, header, data_mask, header_mask):
@@ -875,11 +1389,25 @@ def cosmics_corr (data, header, data_mask, header_mask):
         t = time.time()
 
     satlevel_electrons = set_blackbox.satlevel*np.mean(set_blackbox.gain) 
-    mask_cr, data = astroscrappy.detect_cosmics(
-        data, inmask=(data_mask!=0), sigclip=set_blackbox.sigclip,
-        sigfrac=set_blackbox.sigfrac, objlim=set_blackbox.objlim, niter=set_blackbox.niter,
-        readnoise=header['RDNOISE'], satlevel=satlevel_electrons,
-        cleantype='medmask')
+    if set_blackbox.cosmics_tiled:
+        mask_cr, data_clean = cosmics_tiled(data, data_mask, header['RDNOISE'],
+                                            satlevel_electrons)
+        if set_blackbox.cosmics_validate:
+            # compare with the detection on the full frame
+            mask_cr_full, __ = run_astroscrappy(data, data_mask!=0, header['RDNOISE'],
+                                                satlevel_electrons)
+            struct = np.ones((3,3), dtype=bool)
+            __, ncosmics_tiled = ndimage.label(mask_cr, structure=struct)
+            __, ncosmics_full = ndimage.label(mask_cr_full, structure=struct)
+            log.info('number of cosmic rays in tiles: {}, in full frame: {}; '
+                     'number of pixels with different cosmic-ray mask: {}'
+                     .format(ncosmics_tiled, ncosmics_full,
+                             np.sum(mask_cr != mask_cr_full)))
+            del mask_cr_full
+        data = data_clean
+    else:
+        mask_cr, data = run_astroscrappy(data, data_mask!=0, header['RDNOISE'],
+                                         satlevel_electrons)
     
     # from astroscrappy 'manual': To reproduce the most similar
     # behavior to the original LA Cosmic (written in IRAF), set inmask
@@ -911,45 +1439,132 @@ def cosmics_corr (data, header, data_mask, header_mask):
 
 ################################################################################
 
-def mask_init (data, header):
+def run_astroscrappy (data, inmask, readnoise, satlevel):
+
+    """Function that runs astroscrappy's [detect_cosmics] on [data]
+       with mask [inmask] and the parameters defined in
+       [set_blackbox]; returns the cosmic-ray mask and the cleaned
+       data."""
+
+    return astroscrappy.detect_cosmics(
+        data, inmask=inmask, sigclip=set_blackbox.sigclip,
+        sigfrac=set_blackbox.sigfrac, objlim=set_blackbox.objlim, niter=set_blackbox.niter,
+        readnoise=readnoise, satlevel=satlevel, cleantype='medmask')
+
+
+################################################################################
+
+def cosmics_tiled (data, data_mask, readnoise, satlevel):
+
+    """Function that detects the cosmic rays in [data] with
+       [run_astroscrappy] in tiles of the channel data sections
+       [set_blackbox.data_sec_red], extended on each side by
+       [set_blackbox.cosmics_margin] pixels; the tiles are divided
+       over [set_blackbox.cosmics_nthread] threads. Only the channel
+       data sections of the resulting cosmic-ray mask and cleaned
+       data are used, so that the results near the tile edges are
+       not affected by the missing neighbouring pixels as long as
+       the margin is wide enough. Returns the cosmic-ray mask and
+       cleaned data.
+
+    """
+
+    ysize, xsize = np.shape(data)
+    margin = set_blackbox.cosmics_margin
+
+    mask_cr = np.zeros((ysize, xsize), dtype=bool)
+    data_clean = np.zeros((ysize, xsize), dtype='float32')
+
+    def detect_tile (sec):
+        # tile including margin
+        y1 = max(sec[0].start-margin, 0)
+        y2 = min(sec[0].stop+margin, ysize)
+        x1 = max(sec[1].start-margin, 0)
+        x2 = min(sec[1].stop+margin, xsize)
+        mask_tile, data_tile = run_astroscrappy(data[y1:y2,x1:x2],
+                                                data_mask[y1:y2,x1:x2]!=0,
+                                                readnoise, satlevel)
+        # channel data section within the tile
+        sec_tile = (slice(sec[0].start-y1, sec[0].stop-y1),
+                    slice(sec[1].start-x1, sec[1].stop-x1))
+        mask_cr[sec] = mask_tile[sec_tile]
+        data_clean[sec] = data_tile[sec_tile]
+
+    data_sec_red = set_blackbox.data_sec_red
+    nthread = min(set_blackbox.cosmics_nthread, len(data_sec_red))
+    if nthread > 1:
+        pool = ThreadPool(nthread)
+        pool.map(detect_tile, data_sec_red)
+        pool.close()
+        pool.join()
+    else:
+        for sec in data_sec_red:
+            detect_tile(sec)
+
+    return mask_cr, data_clean
+
+
+################################################################################
+
+def mask_init (data, header, data_mask=None, mask_infnan=None, mask_sat=None,
+               filt=None, date_eve=None):
 
     """Function to create initial mask from the bad pixel mask (defining
-       the bad and edge pixels), and pixels that are saturated and
-       pixels connected to saturated pixels.
+       the bad and edge pixels) for filter [filt] and evening date
+       [date_eve], and pixels that are saturated and pixels connected
+       to saturated pixels.
+
+       If [data_mask], the masks of non-finite pixels [mask_infnan]
+       and/or saturated pixels [mask_sat] were already determined
+       (e.g. by [reduce_fused]), they can be provided; in that case
+       the non-finite pixels in [data] are assumed to have been set to
+       zero already.
+
+       The mask is updated in place, using at most two full-frame
+       boolean scratch arrays.
 
     """
     
     if set_zogy.timing:
         t = time.time()
 
-    fits_bpm = unzip(set_blackbox.bad_pixel_mask)
-    if os.path.isfile(fits_bpm):
-        # if it exists, read it
-        data_mask = read_hdulist(fits_bpm, ext_data=0)
-    else:
-        # if not, create uint8 array of zeros with same shape as
-        # [data]
-        data_mask = np.zeros(np.shape(data), dtype='uint8')
-
-    # mask of pixels with non-finite values in [data]
-    mask_infnan = ~np.isfinite(data)
-    # replace those pixel values with zeros
-    data[mask_infnan] = 0
+    if data_mask is None:
+        data_mask, fits_bpm = get_bpm(np.shape(data), filt=filt, date_eve=date_eve)
+        bpm_header(header, fits_bpm)
+    data_mask = np.asarray(data_mask, dtype='uint8')
+
+    # scratch arrays
+    mask_temp1 = np.empty(np.shape(data), dtype=bool)
+    mask_temp2 = np.empty(np.shape(data), dtype=bool)
+
+    if mask_infnan is None:
+        # mask of pixels with non-finite values in [data]
+        mask_infnan = np.isfinite(data, out=mask_temp1)
+        np.logical_not(mask_infnan, out=mask_infnan)
+        # replace those pixel values with zeros
+        np.copyto(data, 0, where=mask_infnan)
     # and add them to [data_mask] with same value defined for 'bad' pixels
     # unless that pixel was already masked
-    data_mask[(mask_infnan) & (data_mask==0)] += set_zogy.mask_value['bad']
+    mask_add = np.equal(data_mask, 0, out=mask_temp2)
+    np.logical_and(mask_add, mask_infnan, out=mask_add)
+    np.add(data_mask, set_zogy.mask_value['bad'], out=data_mask, where=mask_add)
     
     # identify saturated pixels
     satlevel_electrons = set_blackbox.satlevel*np.mean(set_blackbox.gain) 
-    mask_sat = (data >= satlevel_electrons)
+    if mask_sat is None:
+        mask_sat = np.greater_equal(data, satlevel_electrons, out=mask_temp1)
     # add them to the mask of edge and bad pixels
-    data_mask[mask_sat] += set_zogy.mask_value['saturated']
+    np.add(data_mask, set_zogy.mask_value['saturated'], out=data_mask, where=mask_sat)
 
     # and pixels connected to saturated pixels
     struct = np.ones((3,3), dtype=bool)
-    mask_satconnect = ndimage.binary_dilation(mask_sat, structure=struct)
-    # add them to the mask
-    data_mask[(mask_satconnect) & (~mask_sat)] += set_zogy.mask_value['saturated-connected']
+    mask_satconnect = ndimage.binary_dilation(mask_sat, structure=struct,
+                                              output=mask_temp2)
+    # add them to the mask, excluding the saturated pixels themselves
+    np.greater(mask_satconnect, mask_sat, out=mask_satconnect)
+    np.add(data_mask, set_zogy.mask_value['saturated-connected'], out=data_mask,
+           where=mask_satconnect)
+    del mask_temp1, mask_temp2
 
     # create initial mask header 
     header_mask = fits.Header()
@@ -963,176 +1578,281 @@ def mask_init (data, header):
     if set_zogy.timing:
         log_timing_memory (t0=t, label='mask_init', log=log)
 
-    return data_mask.astype('uint8'), header_mask
+    return data_mask, header_mask
 
 
 ################################################################################
 
-def mask_header(data_mask, header_mask):
+def get_bpm (shape, filt=None, date_eve=None):
 
-    """Function to add info from all reduction steps to mask header"""
-    
-    mask = {}
-    text = {'bad': 'BP', 'edge': 'EP', 'saturated': 'SP',
-            'saturated-connected': 'SCP', 'satellite trail': 'STP',
-            'cosmic ray': 'CRP'}
-    
-    for mask_type in text.keys():
-        value = set_zogy.mask_value[mask_type]
-        mask[mask_type] = (data_mask & value == value)
-        header_mask['M-{}'.format(text[mask_type])] = (
-            True, '{} pixels included in mask?'.format(mask_type))
-        header_mask['M-{}VAL'.format(text[mask_type])] = (
-            value, 'value added to mask for {} pixels'.format(mask_type))
-        header_mask['M-{}NUM'.format(text[mask_type])] = (
-            np.sum(mask[mask_type]), 'number of {} pixels'.format(mask_type))
-        
-    return
+    """Function that returns a private, writable copy of the bad pixel
+       mask for filter [filt] and evening date [date_eve] (see
+       [select_bpm]) and its file name, or an uint8 array of zeros
+       with shape [shape] and None if there is no such mask. The mask
+       is read only once per process and kept in [bpm_cache], or, if
+       [set_blackbox.shared_cal] is True, once per machine and shared
+       between the processes with [get_shared_cal], in which case the
+       copy is a copy-on-write view of the shared mask.
 
-    
-################################################################################
+    """
 
-def master_corr (data, header, data_mask, path, date_eve, filt, imtype):
+    fits_bpm = select_bpm(filt, date_eve)
+    if fits_bpm is None:
+        # if there is no mask, create uint8 array of zeros with shape [shape]
+        return np.zeros(shape, dtype='uint8'), None
 
-    if set_zogy.timing:
-        t = time.time()
+    if set_blackbox.shared_cal:
+        # copy-on-write view of the shared mask
+        data_bpm = get_shared_cal(
+            fits_bpm, lambda: read_fits_mem(fits_bpm, get_header=False), mode='c')
+    else:
+        # the cache key includes the modification time, so that an
+        # updated mask is read again
+        key = (os.path.realpath(fits_bpm), os.path.getmtime(fits_bpm))
+        if key not in bpm_cache:
+            bpm_cache_stats['misses'] += 1
+            for key_old in [k for k in bpm_cache if k[0] == key[0]]:
+                del bpm_cache[key_old]
+            log.info('reading bad pixel mask {}'.format(fits_bpm))
+            bpm_cache[key] = read_fits_mem(fits_bpm, get_header=False)
+        else:
+            bpm_cache_stats['hits'] += 1
+        data_bpm = np.copy(bpm_cache[key])
 
-    if imtype=='flat':
-        fits_master = '{}/{}_{}_{}.fits'.format(path, imtype, date_eve, filt)
-    elif imtype=='bias':
-        fits_master = '{}/{}_{}.fits'.format(path, imtype, date_eve)
+    return data_bpm, fits_bpm
 
-    log.info('fits_master: {}'.format(fits_master))
-        
-    if not os.path.isfile(unzip(fits_master)):
 
-        # prepare master from files in [path]
-        if imtype=='flat':
-            file_list = sorted(glob.glob('{}/*_{}.fits*'.format(path, filt)))
-        elif imtype=='bias':
-            file_list = sorted(glob.glob('{}/*fits*'.format(path)))
+# bad pixel masks read by this process, with keys (file name,
+# modification time), and its number of hits and misses
+bpm_cache = {}
+bpm_cache_stats = {'hits': 0, 'misses': 0}
+
 
-        # initialize cube of images to be combined
-        nfiles = np.shape(file_list)[0]
+################################################################################
 
-        # if there are too few frames to make tonight's master, look
-        # for a nearby master flat instead
-        if nfiles < 3:
+def select_bpm (filt, date_eve):
 
-            fits_master_close = get_closest_biasflat(date_eve, imtype, filt=filt)
-            if fits_master_close is not None:
+    """Function that returns the name of the bad pixel mask for filter
+       [filt] and evening date [date_eve]: the last entry in
+       [set_blackbox.bpm_list] that applies to [filt] and [date_eve],
+       or [set_blackbox.bad_pixel_mask] if there is none. The fpacked
+       version of the mask is used if the uncompressed one does not
+       exist; None is returned if neither exists.
 
-                fits_master_close = unzip(fits_master_close)
-                print ('Warning: too few images available to produce master {}; instead using\n{}'
-                       .format(imtype, fits_master_close))
-                # create symbolic link so future files will automatically
-                # use this as the master flat
-                os.symlink(fits_master_close, fits_master)
+    """
 
-            else:
-                log.error('no alternative master {} found'.format(imtype))
-                return data
-                
-        else:
-            
-            print ('making master {} in filter {}'.format(imtype, filt))
-
-            # assuming that individual flats/biases have the same shape as the input data
-            master_cube = np.zeros((nfiles, np.shape(data)), dtype='float32')
-
-            # fill the cube
-            for i_file, filename in enumerate(file_list):
-                data_temp, header_temp = read_hdulist(file_list[i_file],
-                                                        ext_data=0, ext_header=0)
-
-                if imtype=='flat':
-                    # divide by median over the region [set_blackbox.flat_norm_sec]
-                    mean, std, median = clipped_stats(data_temp[set_blackbox.flat_norm_sec])
-                    print ('flat name: {}, mean: {}, std: {}, median: {}'
-                           .format(filename, mean, std, median))
-                    master_cube[i_file] = data_temp / median
-                    
-                if i_file==0:
-                    for key in header_temp.keys():
-                        if 'BIASM' in key or 'RDN' in key:
-                            del header_temp[key]
-                    header_master = header_temp
-                    
-                if imtype=='flat':
-                    comment = 'name reduced flat'
-                elif imtype=='bias':
-                    comment = 'name gain/os-corrected bias frame'
-
-                header_master['{}{}'.format(imtype.upper(), i_file+1)] = (
-                    filename.split('/')[-1], '{} {}'.format(comment, i_file+1))
-                
-                if 'ORIGFILE' in header_temp.keys():
-                    header_master['{}OR{}'.format(imtype.upper(), i_file+1)] = (
-                        header_temp['ORIGFILE'], 'name original {} {}'
-                        .format(imtype, i_file+1))
-
-
-            # determine the median
-            master_median = np.median(master_cube, axis=0)
-
-            # add some header keywords to the master flat
-            if imtype=='flat':
-                sec_temp = set_blackbox.flat_norm_sec
-                value_temp = '[{}:{},{}:{}]'.format(sec_temp[0].start+1, sec_temp[0].stop+1,
-                                                    sec_temp[1].start+1, sec_temp[1].stop+1) 
-                header_master['STATSEC'] = (value_temp,
-                                            'pre-defined statistics section [y1:y2,x1:x2]')
-                header_master['SECMED'] = (np.median(flat_median[sec_temp]),
-                                           '[e-] median master flat over STATSEC')
-                header_master['SECSTD'] = (np.std(flat_median[sec_temp]),
-                                           '[e-] sigma (STD) master flat over STATSEC')
-
-                # for full image statistics, discard masked pixels
-                mask_ok = (data_mask==0)
-                header_master['FLATMED'] = (np.median(flat_median[mask_ok]),
-                                            '[e-] median master flat')
-                header_master['FLATSTD'] = (np.std(flat_median[mask_ok]),
-                                            '[e-] sigma (STD) master flat')
-
-            elif imtype=='bias':
-
-                # add some header keywords to the master bias
-                mean_master, std_master = clipped_stats(bias_median, get_median=False)
-                header_master['BIASMEAN'] = (mean_master, '[e-] mean master bias')
-                header_master['RDNOISE'] = (std_master, '[e-] sigma (STD) master bias')
-
-                # including the means and standard deviations of the master
-                # bias in the separate channels
-                data_sec_red = set_blackbox.data_sec_red
-                nchans = np.shape(data_sec_red)[0]
-                mean_chan = np.zeros(nchans)
-                std_chan = np.zeros(nchans)
-
-                for i_chan in range(nchans):
-                    data_chan = bias_median[data_sec_red[i_chan]]
-                    mean_chan[i_chan], std_chan[i_chan] = clipped_stats(data_chan, get_median=False)
-                for i_chan in range(nchans):
-                    header_master['BIASM{}'.format(i_chan+1)] = (
-                        mean_chan[i_chan], '[e-] channel {} mean master bias'.format(i_chan+1))
-                for i_chan in range(nchans):
-                    header_master['RDN{}'.format(i_chan+1)] = (
-                        std_chan[i_chan], '[e-] channel {} sigma (STD) master bias'.format(i_chan+1))
-
-            # write to output file
-            fits.writeto(fits_master, master_median.astype('float32'), header_master,
-                         overwrite=True)
+    fits_bpm = set_blackbox.bad_pixel_mask
+    for bpm_filt, bpm_date, bpm_file in set_blackbox.bpm_list:
+        if ((bpm_filt is None or bpm_filt == filt) and
+            (bpm_date is None or (date_eve is not None and date_eve >= bpm_date))):
+            fits_bpm = bpm_file
 
-            
-    log.info('reading master {}'.format(imtype))
-    master_median = read_hdulist(fits_master, ext_data=0)
-    if os.path.islink(fits_master):
-        master_name = os.readlink(fits_master)
+    if os.path.isfile(fits_bpm):
+        return fits_bpm
+    elif os.path.isfile('{}.fz'.format(fits_bpm)):
+        return '{}.fz'.format(fits_bpm)
     else:
-        master_name = fits_master
-    header['M{}-F'.format(imtype.upper())] = (
-        master_name.split('/')[-1], 'name of master {} applied'.format(imtype))
-    
-    if imtype=='flat':
+        return None
+
+
+################################################################################
+
+def bpm_header (header, fits_bpm):
+
+    """Function that records the name of the bad pixel mask [fits_bpm]
+       applied (None if there is none) in [header]."""
+
+    if fits_bpm is None:
+        bpm_name = ''
+    else:
+        bpm_name = fits_bpm.split('/')[-1]
+    header['BPM-F'] = (bpm_name, 'name of bad pixel mask applied')
+
+    return
+
+
+################################################################################
+
+def get_shared_cal (fits_cal, read_func, mode='r', date_eve=None):
+
+    """Function that returns a memory-mapped view of the data of the
+       calibration file [fits_cal] that is shared by all processes on
+       this machine. The data are published as a numpy (.npy) file in
+       [shared_cal_path] by the first process that needs them, using
+       [read_func] to read the data; any other process that requests
+       the same file in the meantime waits until it is available. The
+       view is read-only for the default [mode] 'r' and copy-on-write
+       for [mode] 'c', in which case changes are private to the
+       process.
+
+       The shared file is tied to the modification time of
+       [fits_cal]: if that changes, e.g. because a master is remade,
+       the data are published again under a new name and the previous
+       version is removed. Processes that still use the previous
+       version keep a valid view until they release it.
+
+       If the evening date [date_eve] for which the file is used is
+       provided, as for the masters, the shared files of masters used
+       for earlier dates are removed when it is published, so that the
+       new night's masters replace the old ones; files without a date,
+       such as the bad pixel mask, are kept. All shared files are
+       removed by [clean_shared_cal] at the start and end of
+       [run_blackbox].
+
+    """
+
+    fits_real = os.path.realpath(fits_cal)
+    base = '{}/{}'.format(shared_cal_path, fits_real.strip('/').replace('/','_'))
+    if date_eve is not None:
+        base = '{}/date{}_{}'.format(shared_cal_path, date_eve, base.split('/')[-1])
+    fits_npy = '{}_{:.6f}.npy'.format(base, os.path.getmtime(fits_real))
+
+    if not os.path.isfile(fits_npy):
+
+        if not os.path.isdir(shared_cal_path):
+            try:
+                os.makedirs(shared_cal_path)
+            except OSError:
+                # directory was made by another process in the meantime
+                pass
+
+        # only a single process should read and publish the data
+        with open('{}.lock'.format(base), 'w') as f_lock:
+            fcntl.flock(f_lock, fcntl.LOCK_EX)
+            try:
+                if not os.path.isfile(fits_npy):
+                    log.info('publishing {} in {}'.format(fits_cal, fits_npy))
+                    data = read_func()
+                    # save in native byte order; write to a temporary
+                    # file first, so other processes never see an
+                    # incomplete file
+                    fits_tmp = '{}.{}.tmp'.format(fits_npy, os.getpid())
+                    with open(fits_tmp, 'wb') as f_npy:
+                        np.save(f_npy, data.astype(data.dtype.newbyteorder('=')))
+                    os.rename(fits_tmp, fits_npy)
+                    # remove previous versions
+                    for fits_old in glob.glob('{}_*.npy'.format(base)):
+                        if fits_old != fits_npy:
+                            os.remove(fits_old)
+                    # and the files used for earlier dates
+                    if date_eve is not None:
+                        release_shared_cal(date_eve)
+            finally:
+                fcntl.flock(f_lock, fcntl.LOCK_UN)
+
+    return np.load(fits_npy, mmap_mode=mode)
+
+
+# directory of the calibration files shared between processes, set
+# for the telescope in [run_blackbox]
+shared_cal_path = set_blackbox.shm_dir
+
+
+################################################################################
+
+def release_shared_cal (date_eve):
+
+    """Function that removes the calibration files in [shared_cal_path]
+       that were shared by [get_shared_cal] for evening dates before
+       [date_eve]. Processes that still use them keep a valid view
+       until they release it."""
+
+    for fits_old in glob.glob('{}/date????????_*'.format(shared_cal_path)):
+        date_old = fits_old.split('/')[-1][4:12]
+        if date_old < date_eve:
+            log.info('releasing shared calibration file {}'.format(fits_old))
+            try:
+                os.remove(fits_old)
+            except OSError:
+                # removed by another process in the meantime
+                pass
+
+    return
+
+
+################################################################################
+
+def clean_shared_cal ():
+
+    """Function that removes all calibration files in [shared_cal_path]
+       that are shared by [get_shared_cal]."""
+
+    if os.path.isdir(shared_cal_path):
+        shutil.rmtree(shared_cal_path, ignore_errors=True)
+
+    return
+
+
+################################################################################
+
+def mask_header(data_mask, header_mask):
+
+    """Function to add info from all reduction steps to mask header"""
+    
+    text = {'bad': 'BP', 'edge': 'EP', 'saturated': 'SP',
+            'saturated-connected': 'SCP', 'satellite trail': 'STP',
+            'cosmic ray': 'CRP'}
+
+    # count the number of pixels of each mask value in a single pass
+    # through the mask; the number of pixels of each mask type is the
+    # sum over the mask values that include it
+    values = np.arange(256)
+    counts = np.bincount(np.asarray(data_mask, dtype='uint8').ravel(),
+                         minlength=256)
+    
+    for mask_type in text.keys():
+        value = set_zogy.mask_value[mask_type]
+        header_mask['M-{}'.format(text[mask_type])] = (
+            True, '{} pixels included in mask?'.format(mask_type))
+        header_mask['M-{}VAL'.format(text[mask_type])] = (
+            value, 'value added to mask for {} pixels'.format(mask_type))
+        header_mask['M-{}NUM'.format(text[mask_type])] = (
+            np.sum(counts[(values & value) == value]),
+            'number of {} pixels'.format(mask_type))
+        
+    return
+
+    
+################################################################################
+
+def master_corr (data, header, data_mask, path, date_eve, filt, imtype):
+
+    if set_zogy.timing:
+        t = time.time()
+
+    fits_master = get_fits_master(path, date_eve, filt, imtype)
+    log.info('fits_master: {}'.format(fits_master))
+
+    # no need to check for the master file if it is in the cache
+    master = get_master_cache(fits_master, imtype, date_eve, filt)
+    if master is None and not os.path.isfile(fits_master):
+
+        # only one process at a time builds the master; once the lock
+        # is acquired, check again whether it was not built by another
+        # process in the meantime
+        lock.acquire()
+        try:
+            fits_master = get_fits_master(path, date_eve, filt, imtype)
+            if not os.path.isfile(fits_master):
+                build_master(path, date_eve, filt, imtype, data_mask=data_mask)
+        finally:
+            lock.release()
+
+        # the master may have been written fpacked
+        fits_master = get_fits_master(path, date_eve, filt, imtype)
+        if not os.path.isfile(fits_master):
+            return data
+
+    if master is None:
+        log.info('reading master {}'.format(imtype))
+        master = read_master(fits_master, imtype, date_eve, filt)
+    else:
+        master_cache_stats['hits'] += 1
+    master_median, master_name = master
+    header['M{}-F'.format(imtype.upper())] = (
+        master_name.split('/')[-1], 'name of master {} applied'.format(imtype))
+    
+    if imtype=='flat':
         # divide data by the normalised flat
         # do not consider pixels with zero values or edge pixels
         mask_ok = ((master_median != 0) & (data_mask != set_zogy.mask_value['edge']))
@@ -1149,251 +1869,740 @@ def master_corr (data, header, data_mask, path, date_eve, filt, imtype):
 
 ################################################################################
 
-def mflat_corr(data, header, data_mask, flat_path, date_eve, filt):
+def build_master (path, date_eve, filt, imtype, data_mask=None):
+
+    """Function that builds the master bias or flat for [date_eve]
+       (and [filt] in case of the flat) from the reduced bias or flat
+       frames in [path]. If there are too few frames, a symbolic link
+       to the closest master available is created instead. If
+       [data_mask] is not provided, the full-image statistics of the
+       master flat are determined from the pixels that are not
+       flagged in the bad pixel mask. Returns the name of the master,
+       or None if no master could be made or found.
+
+    """
 
     if set_zogy.timing:
         t = time.time()
-        
-    fits_mflat = '{}/flat_{}_{}.fits'.format(flat_path, date_eve, filt)
-    if not os.path.isfile(unzip(fits_mflat)):
 
-        # prepare master flat from flats in [flat_path]
-        flat_list = sorted(glob.glob('{}/*_{}.fits*'.format(flat_path, filt)))
+    fits_master = get_fits_master(path, date_eve, filt, imtype)
 
-        # initialize cube of flats to be combined
-        nflat = np.shape(flat_list)[0]
+    # prepare master from files in [path]
+    if imtype=='flat':
+        file_list = sorted(glob.glob('{}/*_{}.fits*'.format(path, filt)))
+    elif imtype=='bias':
+        file_list = sorted(glob.glob('{}/*fits*'.format(path)))
 
-        # if there are too few bias frames to make tonight's master
-        # flat, look for a nearby master flat instead
-        if nflat < 3:
+    # initialize cube of images to be combined
+    nfiles = np.shape(file_list)[0]
 
-            fits_mflat_close = get_closest_biasflat(date_eve, 'flat', filt=filt)
+    # if there are too few frames to make tonight's master, look
+    # for a nearby master flat instead
+    if nfiles < 3:
 
-            if fits_mflat_close is not None:
+        fits_master_close = get_closest_biasflat(date_eve, imtype, filt=filt)
+        if fits_master_close is not None:
 
-                fits_mflat_close = unzip(fits_mflat_close)
-                print ('Warning: too few flats available to produce master flat; instead using\n{}'
-                       .format(fits_mflat_close))
-                # create symbolic link so future files will automatically
-                # use this as the master flat
-                os.symlink(fits_mflat_close, fits_mflat)
+            print ('Warning: too few images available to produce master {}; instead using\n{}'
+                   .format(imtype, fits_master_close))
+            # create symbolic link so future files will automatically
+            # use this as the master flat; if the closest master is
+            # fpacked, so is the link name
+            if '.fz' in fits_master_close:
+                fits_master = '{}.fz'.format(fits_master)
+            os.symlink(fits_master_close, fits_master)
 
-            else:
-                log.error('no alternative master flat found')
-                return data
-                
         else:
+            log.error('no alternative master {} found'.format(imtype))
+            return None
             
-            print ('making master flat in filter {}'.format(filt))
-
-            # assuming that flats have the same shape as the input data
-            ysize, xsize = np.shape(data)
-            flat_cube = np.zeros((nflat, ysize, xsize), dtype='float32')
-
-            # fill the cube
-            for i_flat, flat in enumerate(flat_list):
-                flat_temp, header_temp = read_hdulist(flat_list[i_flat],
-                                                      ext_data=0, ext_header=0)
-                # divide by median over the region [set_blackbox.flat_norm_sec]
-                mean, std, median = clipped_stats(flat_temp[set_blackbox.flat_norm_sec])
-                print ('flat name: {}, mean: {}, std: {}, median: {}'.format(flat, mean, std, median))
-                flat_cube[i_flat] = flat_temp / median
-
-                if i_flat==0:
-                    for key in header_temp.keys():
-                        if 'BIASM' in key or 'RDN' in key:
-                            del header_temp[key]
-                    header_mflat = header_temp
-
-                flat_short = flat.split('/')[-1]
-                header_mflat['FLAT{}'.format(i_flat+1)] = (
-                    flat_short, 'name reduced flat {}'.format(i_flat+1))
-                if 'ORIGFILE' in header_temp.keys():
-                    flat_orig = header_temp['ORIGFILE']
-                    header_mflat['FLATOR{}'.format(i_flat+1)] = (
-                        flat_orig, 'name original flat {}'.format(i_flat+1))
+    else:
+        
+        print ('making master {} in filter {}'.format(imtype, filt))
 
-            
-            # determine the clipped mean
-            #flat_mean, flat_median, flat_std = sigma_clipped_stats(flat_cube, axis=0)
-            # or simply the median:
-            flat_median = np.median(flat_cube, axis=0)
+        # combine the frames in strips of rows; flats are first
+        # normalised by their median over the region
+        # [set_blackbox.flat_norm_sec]
+        if imtype=='flat':
+            norm_sec = set_blackbox.flat_norm_sec
+        else:
+            norm_sec = None
+        master_median, header_list = combine_frames(file_list, norm_sec=norm_sec)
+
+        # prepare master header from the header of the first frame
+        header_master = header_list[0]
+        for key in list(header_master.keys()):
+            if 'BIASM' in key or 'RDN' in key:
+                del header_master[key]
+
+        if imtype=='flat':
+            comment = 'name reduced flat'
+        elif imtype=='bias':
+            comment = 'name gain/os-corrected bias frame'
+
+        for i_file, filename in enumerate(file_list):
+            header_master['{}{}'.format(imtype.upper(), i_file+1)] = (
+                filename.split('/')[-1], '{} {}'.format(comment, i_file+1))
+            if 'ORIGFILE' in header_list[i_file].keys():
+                header_master['{}OR{}'.format(imtype.upper(), i_file+1)] = (
+                    header_list[i_file]['ORIGFILE'], 'name original {} {}'
+                    .format(imtype, i_file+1))
 
-            # add some header keywords to the master flat
+        # add some header keywords to the master flat
+        if imtype=='flat':
             sec_temp = set_blackbox.flat_norm_sec
             value_temp = '[{}:{},{}:{}]'.format(sec_temp[0].start+1, sec_temp[0].stop+1,
                                                 sec_temp[1].start+1, sec_temp[1].stop+1) 
-            header_mflat['STATSEC'] = (value_temp, 'pre-defined statistics section [y1:y2,x1:x2]')
-            header_mflat['SECMED'] = (np.median(flat_median[sec_temp]), '[e-] median master flat over STATSEC')
-            header_mflat['SECSTD'] = (np.std(flat_median[sec_temp]),    '[e-] sigma (STD) master flat over STATSEC')
+            header_master['STATSEC'] = (value_temp,
+                                        'pre-defined statistics section [y1:y2,x1:x2]')
+            header_master['SECMED'] = (np.median(master_median[sec_temp]),
+                                       '[e-] median master flat over STATSEC')
+            header_master['SECSTD'] = (np.std(master_median[sec_temp]),
+                                       '[e-] sigma (STD) master flat over STATSEC')
 
             # for full image statistics, discard masked pixels
+            if data_mask is None:
+                data_mask, __ = get_bpm(np.shape(master_median), filt=filt,
+                                        date_eve=date_eve)
             mask_ok = (data_mask==0)
-            header_mflat['FLATMED'] = (np.median(flat_median[mask_ok]), '[e-] median master flat')
-            header_mflat['FLATSTD'] = (np.std(flat_median[mask_ok]), '[e-] sigma (STD) master flat')
-                
-            # write to output file
-            fits.writeto(fits_mflat, flat_median.astype('float32'), header_mflat,
-                         overwrite=True)
+            header_master['FLATMED'] = (np.median(master_median[mask_ok]),
+                                        '[e-] median master flat')
+            header_master['FLATSTD'] = (np.std(master_median[mask_ok]),
+                                        '[e-] sigma (STD) master flat')
 
+        elif imtype=='bias':
+
+            # add some header keywords to the master bias
+            mean_master, std_master = clipped_stats(master_median, get_median=False)
+            header_master['BIASMEAN'] = (mean_master, '[e-] mean master bias')
+            header_master['RDNOISE'] = (std_master, '[e-] sigma (STD) master bias')
+
+            # including the means and standard deviations of the master
+            # bias in the separate channels
+            data_sec_red = set_blackbox.data_sec_red
+            nchans = np.shape(data_sec_red)[0]
+            def stats_chan (i_chan):
+                data_chan = master_median[data_sec_red[i_chan]]
+                return clipped_stats(data_chan, get_median=False)
+            mean_chan, std_chan = np.array(chan_map(stats_chan, nchans)).T
+            for i_chan in range(nchans):
+                header_master['BIASM{}'.format(i_chan+1)] = (
+                    mean_chan[i_chan], '[e-] channel {} mean master bias'.format(i_chan+1))
+            for i_chan in range(nchans):
+                header_master['RDN{}'.format(i_chan+1)] = (
+                    std_chan[i_chan], '[e-] channel {} sigma (STD) master bias'.format(i_chan+1))
+
+        # write to output file
+        fits_master = write_fits(fits_master, master_median.astype('float32'),
+                                 header_master)
+        # and add it to the calibration index
+        cal_index_add(fits_master, imtype, date_eve, filt)
 
-    log.info('reading master flat')
-    flat_median = read_hdulist(fits_mflat, ext_data=0)
-    if os.path.islink(fits_mflat):
-        mflat_name = os.readlink(fits_mflat)
-    else:
-        mflat_name = fits_mflat
-    header['MFLAT-F'] = (mflat_name.split('/')[-1], 'name of master flat applied')
-       
-    # divide data by the normalised flat
-    # do not consider pixels with zero values or edge pixels
-    mask_ok = ((flat_median != 0) & (data_mask != set_zogy.mask_value['edge']))
-    data[mask_ok] /= flat_median[mask_ok]
-               
     if set_zogy.timing:
-        log_timing_memory (t0=t, label='mflat_corr', log=log)
+        log_timing_memory (t0=t, label='build_master', log=log)
+
+    return fits_master
 
-    return data
-    
 
 ################################################################################
 
-def mbias_corr(data, header, bias_path, date_eve):
+def get_fits_master (path, date_eve, filt, imtype):
 
-    if set_zogy.timing:
-        t = time.time()
-        
-    fits_mbias = '{}/bias_{}.fits'.format(bias_path, date_eve)
-    
-    if not os.path.isfile(unzip(fits_mbias)):
+    """Function that returns the name of the master bias or flat for
+       [date_eve] (and [filt] in case of the flat) in [path], with
+       the extension .fz added if the master is fpacked."""
 
-        # prepare master bias from biases in [bias_path]
-        bias_list = sorted(glob.glob(bias_path+'/*fits*'))
+    if imtype=='flat':
+        fits_master = '{}/{}_{}_{}.fits'.format(path, imtype, date_eve, filt)
+    elif imtype=='bias':
+        fits_master = '{}/{}_{}.fits'.format(path, imtype, date_eve)
 
-        # initialize cube of biases to be combined
-        nbias = np.shape(bias_list)[0]
-        
-        # if there are too few bias frames to make tonight's master
-        # bias, look for a nearby master bias instead
-        if nbias < 5:
-            
-            fits_mbias_close = get_closest_biasflat(date_eve, 'bias')
+    # the master may have been written fpacked
+    if os.path.isfile('{}.fz'.format(fits_master)):
+        fits_master = '{}.fz'.format(fits_master)
 
-            if fits_mbias_close is not None:
+    return fits_master
 
-                fits_mbias_close = unzip(fits_mbias_close)
-                print ('Warning: too few biases available to produce master bias; instead using\n{}'
-                       .format(fits_mbias_close))            
-                # create symbolic link so future files will automatically
-                # use this as the master bias
-                os.symlink(fits_mbias_close, fits_mbias)
-                
-            else:
-                log.error('Error: no alternative master bias found')
-                return data
-            
-        else:
-            
-            print ('making master bias')
-
-            # assuming that biases have the same shape as the input data
-            ysize, xsize = np.shape(data)
-            bias_cube = np.zeros((nbias, ysize, xsize), dtype='float32')
-
-            # fill the cube
-            for i_bias, bias in enumerate(bias_list):
-                bias_cube[i_bias], header_temp = read_hdulist(bias_list[i_bias],
-                                                              ext_data=0, ext_header=0)
-                if i_bias==0:
-                    for key in header_temp.keys():
-                        if 'BIASM' in key or 'RDN' in key:
-                            del header_temp[key]
-                    header_mbias = header_temp
-                
-                bias_short = bias.split('/')[-1]
-                header_mbias['BIAS{}'.format(i_bias+1)] = (
-                    bias_short, 'name gain/os-corrected bias frame {}'.format(i_bias+1))
-                if 'ORIGFILE' in header_temp.keys():
-                    bias_orig = header_temp['ORIGFILE']
-                    header_mbias['BIASOR{}'.format(i_bias+1)] = (
-                        bias_orig, 'name original bias frame {}'.format(i_bias+1))
 
-            
-            # determine the clipped mean
-            #bias_mean, bias_median, bias_std = sigma_clipped_stats(bias_cube, axis=0)
-            # or simply the mean:
-            bias_median = np.median(bias_cube, axis=0)
+################################################################################
 
-            # add some header keywords to the master bias
-            mean_mbias, std_mbias = clipped_stats(bias_median, get_median=False)
-            header_mbias['BIASMEAN'] = (mean_mbias, '[e-] mean master bias')
-            header_mbias['RDNOISE'] = (std_mbias, '[e-] sigma (STD) master bias')
+def read_master (fits_master, imtype, date_eve, filt):
 
-            # including the means and standard deviations of the master
-            # bias in the separate channels
-            data_sec_red = set_blackbox.data_sec_red
-            nchans = np.shape(data_sec_red)[0]
-            mean_chan = np.zeros(nchans)
-            std_chan = np.zeros(nchans)
+    """Function that returns the data of the master bias or flat
+       [fits_master] together with the name of the master file that
+       was actually used, i.e. the file that [fits_master] links to if
+       it is a symbolic link. The result is taken from the master
+       cache (see [get_master_cache]) if possible; if not, the master
+       is read and added to the cache. The returned data array is
+       read-only.
 
-            for i_chan in range(nchans):
-                data_chan = bias_median[data_sec_red[i_chan]]
-                mean_chan[i_chan], std_chan[i_chan] = clipped_stats(data_chan, get_median=False)
-            for i_chan in range(nchans):
-                header_mbias['BIASM{}'.format(i_chan+1)] = (
-                    mean_chan[i_chan], '[e-] channel {} mean master bias'.format(i_chan+1))
-            for i_chan in range(nchans):
-                header_mbias['RDN{}'.format(i_chan+1)] = (
-                    std_chan[i_chan], '[e-] channel {} sigma (STD) master bias'.format(i_chan+1))
-        
-            # write to output file
-            fits.writeto(fits_mbias, bias_median.astype('float32'), header_mbias,
-                         overwrite=True)
+    """
+
+    master = get_master_cache(fits_master, imtype, date_eve, filt)
+    if master is not None:
+        master_cache_stats['hits'] += 1
+        return master
+
+    master_cache_stats['misses'] += 1
+    if set_blackbox.shared_cal:
+        master_median = get_shared_cal(
+            fits_master, lambda: read_fits_mem(fits_master, get_header=False),
+            date_eve=date_eve)
+    else:
+        master_median = read_fits_mem(fits_master, get_header=False)
+    if os.path.islink(fits_master):
+        master_name = os.readlink(fits_master)
+    else:
+        master_name = fits_master
+
+    # the same array may be returned to many images, so make sure
+    # it is not changed
+    master_median.flags.writeable = False
+
+    # add to cache and remove least recently used masters until the
+    # cache fits within [set_blackbox.master_cache_mb]
+    key = master_cache_key(imtype, date_eve, filt)
+    master_cache.pop(key, None)
+    master_cache[key] = (fits_master, os.path.getmtime(fits_master),
+                         master_median, master_name)
+    while (sum([entry[2].nbytes for entry in master_cache.values()])
+           > set_blackbox.master_cache_mb * 1024**2):
+        key_old = next(iter(master_cache))
+        log.info('removing master {} from cache'.format(master_cache[key_old][0]))
+        del master_cache[key_old]
+
+    return master_median, master_name
+
+
+################################################################################
+
+def get_master_cache (fits_master, imtype, date_eve, filt):
+
+    """Function that returns the tuple (data, name) of master bias or
+       flat [fits_master] if it is present in the master cache of this
+       process and it was not modified after it was read; otherwise
+       None is returned. The cache holds the masters that were most
+       recently used, with key (imtype, date_eve, filt) and a total
+       size of at most [set_blackbox.master_cache_mb] MB.
+
+    """
+
+    key = master_cache_key(imtype, date_eve, filt)
+    if key not in master_cache:
+        return None
+
+    entry = master_cache[key]
+    try:
+        # N.B.: getmtime follows symbolic links
+        mtime = os.path.getmtime(fits_master)
+    except OSError:
+        mtime = None
+    if entry[0] != fits_master or entry[1] != mtime:
+        del master_cache[key]
+        return None
+
+    # move to the end as most recently used
+    del master_cache[key]
+    master_cache[key] = entry
+    log.info('using master {} from cache'.format(fits_master))
 
+    return entry[2], entry[3]
 
-    log.info('reading master bias')
-    bias_median = read_hdulist(fits_mbias, ext_data=0)
 
-    if os.path.islink(fits_mbias):
-        mbias_name = os.readlink(fits_mbias)
+################################################################################
+
+def master_cache_key (imtype, date_eve, filt):
+
+    """Function that returns the key of the master cache; the master
+       bias is independent of the filter."""
+
+    if imtype == 'bias':
+        filt = None
+
+    return (imtype, date_eve, filt)
+
+
+# master cache of this process with entries (fits_master, mtime, data,
+# name), ordered from least to most recently used, and its number of
+# hits and misses
+master_cache = OrderedDict()
+master_cache_stats = {'hits': 0, 'misses': 0}
+
+
+################################################################################
+
+def read_hdulist_ref (fits_file, *args, **kwargs):
+
+    """Function that replaces zogy's [read_hdulist] (see
+       [set_blackbox.ref_cache_mb]), so that the reference image, mask
+       and the derived products kept in [set_blackbox.ref_dir] (such
+       as the PSF and catalog) that ZOGY reads for every new image of
+       the same field and filter are read only once per process. The
+       results are kept in [ref_cache] with key the file name, which
+       contains the telescope, field and filter, and the arguments
+       with which it was read; an entry is read again if the file was
+       modified since. The arrays are returned as read-only views of
+       the cached arrays, so that the 450 MB reference image is not
+       copied for every new image; the headers are copies. Files
+       outside [set_blackbox.ref_dir] are read as usual.
+
+    """
+
+    path = os.path.realpath(fits_file)
+    if not path.startswith(os.path.realpath(set_blackbox.ref_dir)+'/'):
+        return read_hdulist_zogy(fits_file, *args, **kwargs)
+
+    key = (path, repr(args), repr(sorted(kwargs.items())))
+    # N.B.: getmtime follows symbolic links
+    mtime = os.path.getmtime(path)
+    entry = ref_cache.pop(key, None)
+
+    if entry is not None and entry[0] == mtime:
+        ref_cache_stats['hits'] += 1
+        log.info('using {} from reference cache'.format(fits_file))
     else:
-        mbias_name = fits_mbias
-    header['MBIAS-F'] = (mbias_name.split('/')[-1], 'name of master bias applied')
-    
-    # subtract from data
-    data -= bias_median
-               
+        ref_cache_stats['misses'] += 1
+        result = read_hdulist_zogy(fits_file, *args, **kwargs)
+        entry = (mtime, ref_cache_view(result), ref_cache_nbytes(result))
+
+    # (re-)add as most recently used and remove least recently used
+    # entries until the cache fits within [set_blackbox.ref_cache_mb];
+    # an entry larger than that is not kept
+    ref_cache[key] = entry
+    while (sum([e[2] for e in ref_cache.values()])
+           > set_blackbox.ref_cache_mb * 1024**2):
+        key_old = next(iter(ref_cache))
+        log.info('removing {} from reference cache'.format(key_old[0]))
+        del ref_cache[key_old]
+
+    return ref_cache_view(entry[1])
+
+
+def ref_cache_view (result):
+
+    """Function that returns read-only views of the arrays and copies
+       of the headers in [result] of [read_hdulist]."""
+
+    if isinstance(result, (tuple, list)):
+        return type(result)([ref_cache_view(r) for r in result])
+    elif isinstance(result, np.ndarray):
+        view = result.view()
+        view.flags.writeable = False
+        return view
+    elif isinstance(result, fits.Header):
+        return result.copy()
+    else:
+        return result
+
+
+def ref_cache_nbytes (result):
+
+    """Function that returns the number of bytes of the arrays in
+       [result] of [read_hdulist]."""
+
+    if isinstance(result, (tuple, list)):
+        return sum([ref_cache_nbytes(r) for r in result])
+    elif isinstance(result, np.ndarray):
+        return result.nbytes
+    else:
+        return 0
+
+
+# reference cache of this process with entries (mtime, result,
+# nbytes), ordered from least to most recently used, and its number
+# of hits and misses
+ref_cache = OrderedDict()
+ref_cache_stats = {'hits': 0, 'misses': 0}
+
+
+
+################################################################################
+
+def handoff_add (filename, data, header):
+
+    """Function that registers [data] and [header], which were just
+       written to [filename], so that ZOGY reads them from memory with
+       [read_hdulist_mem] rather than from [filename], as long as the
+       file is not modified (e.g. when its header is updated)."""
+
+    handoff[os.path.realpath(filename)] = (os.path.getmtime(filename),
+                                           data, header.copy())
+
+
+def read_hdulist_mem (fits_file, *args, **kwargs):
+
+    """Function that replaces zogy's [read_hdulist] if
+       [set_blackbox.zogy_handoff] or [set_blackbox.ref_cache_mb] is
+       set. The reduced image and mask registered with [handoff_add]
+       are returned from memory when the data and/or header of the
+       primary HDU are requested; anything else is read with
+       [read_hdulist_ref] or zogy's [read_hdulist]."""
+
+    entry = handoff.get(os.path.realpath(fits_file))
+    ext_data = kwargs.get('ext_data')
+    ext_header = kwargs.get('ext_header')
+    dtype = kwargs.get('dtype')
+    if (entry is not None and len(args) == 0 and
+        set(kwargs) <= set(['ext_data', 'ext_header', 'dtype']) and
+        ext_data in [None, 0] and ext_header in [None, 0] and
+        (ext_data is not None or ext_header is not None) and
+        os.path.getmtime(fits_file) == entry[0]):
+
+        log.info('using {} from memory'.format(fits_file))
+        # return copies, as ZOGY may change the data
+        result = []
+        if ext_data is not None:
+            result.append(entry[1].astype(dtype if dtype else entry[1].dtype))
+        if ext_header is not None:
+            result.append(entry[2].copy())
+        return tuple(result) if len(result) > 1 else result[0]
+
+    if set_blackbox.ref_cache_mb > 0:
+        return read_hdulist_ref(fits_file, *args, **kwargs)
+    else:
+        return read_hdulist_zogy(fits_file, *args, **kwargs)
+
+
+# images registered with [handoff_add] for the image being processed,
+# with keys the file name and entries (mtime, data, header)
+handoff = {}
+
+# zogy's own [read_hdulist]; [blackbox_reduce] replaces it with
+# [read_hdulist_mem] only while running ZOGY, so that the reduced
+# image and mask are read from memory and the reference files through
+# the reference cache
+read_hdulist_zogy = zogy.read_hdulist
+
+
+################################################################################
+
+def write_async (func, args, logfile, log2keep=None, tmp_path=None):
+
+    """Function that runs [func] with [args], e.g. [copy_files2keep]
+       of the products of an image, in a background thread, so that
+       the process can continue with the next image. [func] should
+       accept the keyword [log], to which a logger is passed that
+       only writes to [logfile], the log of this image: the file
+       handler of [logfile] is moved from the root logger, which is
+       also used for the next image, to this logger. Afterwards,
+       [logfile] is copied to [log2keep], if provided, and [tmp_path]
+       is removed unless [set_blackbox.keep_tmp] is True. A process
+       has at most one such thread: the previous one is waited for
+       first. The thread is not a daemon, so it is also finished when
+       the process exits.
+
+    """
+
+    global write_thread
+    if write_thread is not None:
+        write_thread.join()
+
+    log_write = logging.getLogger('blackbox.write_async')
+    log_write.setLevel(logging.INFO)
+    log_write.propagate = False
+    # file handler of the previous image was closed by its thread
+    for handler in log_write.handlers[:]:
+        if isinstance(handler, logging.FileHandler):
+            log_write.removeHandler(handler)
+
+    log_root = logging.getLogger()
+    for handler in log_root.handlers[:]:
+        if isinstance(handler, logging.FileHandler):
+            if handler.baseFilename == os.path.abspath(logfile):
+                log_root.removeHandler(handler)
+                log_write.addHandler(handler)
+        elif (isinstance(handler, logging.StreamHandler) and
+              len(log_write.handlers) == 0):
+            # warnings and errors also go to the screen
+            streamHandler = logging.StreamHandler()
+            streamHandler.setFormatter(handler.formatter)
+            streamHandler.setLevel(logging.WARN)
+            log_write.addHandler(streamHandler)
+
+    def run ():
+        try:
+            func(*args, log=log_write)
+        except Exception as e:
+            log_write.info(traceback.format_exc())
+            log_write.error('exception was raised during [{}]: {}'
+                            .format(func.__name__, e))
+        for handler in log_write.handlers:
+            if isinstance(handler, logging.FileHandler):
+                handler.close()
+        # [func] may have copied [logfile] before it was complete
+        if log2keep is not None and os.path.isfile(logfile):
+            shutil.copyfile(logfile, log2keep)
+        if (tmp_path is not None and not set_blackbox.keep_tmp and
+            os.path.isdir(tmp_path)):
+            shutil.rmtree(tmp_path)
+
+    write_thread = threading.Thread(target=run)
+    write_thread.start()
+
+
+# background thread of [write_async] of this process
+write_thread = None
+
+
+################################################################################
+
+def combine_frames (file_list, norm_sec=None):
+
+    """Function that combines the images in [file_list] pixel by pixel
+       into a single image, using either the median (identical to
+       np.median along the image axis) or the sigma-clipped mean,
+       depending on [set_blackbox.combine_method]. The images are
+       memory-mapped (or for fpacked images, only the tiles needed
+       are decompressed) and combined in strips of rows, such that the
+       strips being combined do not take up more than about
+       [set_blackbox.combine_mem_mb] MB of memory; the strips are
+       divided over [set_blackbox.combine_nthread] threads, which read
+       the strips of each image in turn. If
+       [norm_sec] is provided, each image is first divided by its
+       clipped median over that section. Returns the combined image
+       and the list of headers of the images.
+
+    """
+
     if set_zogy.timing:
-        log_timing_memory (t0=t, label='mbias_corr', log=log)
+        t = time.time()
+
+    nfiles = len(file_list)
+    hdulist_list = []
+    data_list = []
+    header_list = []
+    norm_list = []
+    # locks with which the strips of each image are read
+    lock_list = []
+
+    try:
+
+        for filename in file_list:
+
+            # the data of a memory-mapped image is only read from disk
+            # when needed, i.e. strip by strip
+            hdulist = fits.open(filename, memmap=True)
+            hdulist_list.append(hdulist)
+            lock_list.append(threading.Lock())
+            # for fpacked images, only the tiles of the rows in a
+            # strip are decompressed, using the section attribute
+            if '.fz' in filename:
+                data_list.append(hdulist[1].section)
+                header_list.append(hdulist[1].header.copy())
+            else:
+                data_list.append(hdulist[0].data)
+                header_list.append(hdulist[0].header.copy())
+
+            if norm_sec is not None:
+                mean, std, median = clipped_stats(data_list[-1][norm_sec])
+                print ('file name: {}, mean: {}, std: {}, median: {}'
+                       .format(filename, mean, std, median))
+                norm_list.append(median)
+            else:
+                norm_list.append(None)
+
+
+        # assuming that all images have the same shape
+        ysize, xsize = np.shape(data_list[0])
+        nthread = max(set_blackbox.combine_nthread, 1)
+
+        # number of rows per strip; each row takes up 4 bytes per
+        # pixel in the strip cube and about the same amount in the
+        # copy that np.median partitions
+        nrows = int(set_blackbox.combine_mem_mb * 1024**2 /
+                    (8 * nfiles * xsize * nthread))
+        nrows = max(min(nrows, ysize), 1)
+
+        data_comb = np.zeros((ysize, xsize), dtype='float32')
+
+        def combine_strip (y1):
+            y2 = min(y1+nrows, ysize)
+            strip_cube = np.zeros((nfiles, y2-y1, xsize), dtype='float32')
+            for i_file in range(nfiles):
+                # the section of an fpacked image reads the tiles
+                # through the file handle that is shared by the
+                # threads, which is not thread-safe, so the strips of
+                # an image are read one at a time; for a
+                # memory-mapped image, this only returns a view that
+                # is read when copied into [strip_cube]
+                with lock_list[i_file]:
+                    data_strip = data_list[i_file][y1:y2]
+                if norm_list[i_file] is None:
+                    strip_cube[i_file] = data_strip
+                else:
+                    strip_cube[i_file] = data_strip / norm_list[i_file]
+
+            if set_blackbox.combine_method == 'clipped_mean':
+                data_comb[y1:y2] = sigma_clipped_stats(strip_cube, axis=0)[0]
+            else:
+                data_comb[y1:y2] = np.median(strip_cube, axis=0)
+
+        y1_list = list(range(0, ysize, nrows))
+        if nthread > 1 and len(y1_list) > 1:
+            pool = ThreadPool(min(nthread, len(y1_list)))
+            pool.map(combine_strip, y1_list)
+            pool.close()
+            pool.join()
+        else:
+            for y1 in y1_list:
+                combine_strip(y1)
+
+    finally:
+        for hdulist in hdulist_list:
+            hdulist.close()
+
+    if set_zogy.timing:
+        log_timing_memory (t0=t, label='combine_frames', log=log)
+
+    return data_comb, header_list
 
-    return data
-    
 
 ################################################################################
 
 def get_closest_biasflat (date_eve, file_type, filt=None):
 
-    search_str = '{}/*/*/*/{}/{}'.format(set_blackbox.red_dir, file_type,
-                                         file_type+'_????????')
+    """Function that returns the name of the master bias or flat (in
+       filter [filt]) that is closest in time to [date_eve], using the
+       calibration index [set_blackbox.cal_index]; None is returned if
+       there is no such master. If the masters present in
+       [set_blackbox.red_dir] were never scanned into the index, e.g.
+       because it only contains the masters added by [build_master]
+       since the index was introduced, it is first rebuilt.
+
+    """
+
     if filt is None:
-        search_str += '.fits*'
-    else:
-        search_str += '_{}.fits*'.format(filt)
+        filt = ''
+    mjd = date2mjd(date_eve)
 
-    files = glob.glob(search_str)
-    nfiles = len(files)
+    conn = cal_index_connect()
+    if conn.execute('SELECT value FROM meta WHERE key=?', ('scanned',)).fetchone() is None:
+        conn.close()
+        rebuild_cal_index()
+        conn = cal_index_connect()
 
-    if nfiles > 0:
-    
-        # find file that is closest in time to [date_eve]
-        mjds = np.array([date2mjd(files[i].split('/')[-1][5:13])
-                         for i in range(nfiles)])
-        i_close = np.argmin(abs(mjds - date2mjd(date_eve)))
-        return files[i_close]
+    try:
+        while True:
+            # closest masters before and after [date_eve]
+            rows = []
+            for query in ['SELECT path, mjd FROM masters WHERE imtype=? AND '
+                          'filt=? AND mjd<=? ORDER BY mjd DESC LIMIT 1',
+                          'SELECT path, mjd FROM masters WHERE imtype=? AND '
+                          'filt=? AND mjd>? ORDER BY mjd ASC LIMIT 1']:
+                rows += conn.execute(query, (file_type, filt, mjd)).fetchall()
+
+            if len(rows) == 0:
+                return None
+
+            fits_close = min(rows, key=lambda row: abs(row[1] - mjd))[0]
+            if os.path.isfile(fits_close):
+                return fits_close
+
+            # master was removed since it was indexed; remove it from
+            # the index as well and try again
+            with conn:
+                conn.execute('DELETE FROM masters WHERE path=?', (fits_close,))
+    finally:
+        conn.close()
+
+
+################################################################################
+
+def cal_index_connect ():
+
+    """Function that returns a connection to the SQLite calibration
+       index [set_blackbox.cal_index], with a table of the available
+       master biases and flats that is indexed on type, filter and
+       date, so that the closest master can be found quickly, and a
+       table [meta] that records when [rebuild_cal_index] last scanned
+       [set_blackbox.red_dir] (key 'scanned')."""
+
+    conn = sqlite3.connect(set_blackbox.cal_index, timeout=60)
+    with conn:
+        conn.execute('CREATE TABLE IF NOT EXISTS masters (path TEXT PRIMARY KEY, '
+                     'imtype TEXT, filt TEXT, date_eve TEXT, mjd REAL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS masters_type_filt_mjd '
+                     'ON masters (imtype, filt, mjd)')
+        conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, '
+                     'value TEXT)')
+
+    return conn
+
+
+################################################################################
+
+def cal_index_add (fits_master, imtype, date_eve, filt):
+
+    """Function that adds master bias or flat [fits_master] to the
+       calibration index [set_blackbox.cal_index]."""
+
+    if filt is None:
+        filt = ''
+
+    conn = cal_index_connect()
+    try:
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO masters VALUES (?, ?, ?, ?, ?)',
+                         (fits_master, imtype, filt, date_eve, date2mjd(date_eve)))
+    finally:
+        conn.close()
+
+
+################################################################################
+
+def rebuild_cal_index ():
+
+    """Function that (re)builds the calibration index
+       [set_blackbox.cal_index] from the master biases and flats
+       present in [set_blackbox.red_dir]. Symbolic links to the
+       closest master, made when there were too few frames to make
+       a master, are not included. Masters that are no longer present
+       are removed, while any masters added by other processes during
+       the scan are kept."""
+
+    rows = []
+    for imtype in ['bias', 'flat']:
+        # the masters are in [red_dir]/[telescope]/yyyy/mm/dd/[imtype],
+        # or without [telescope] if it was not defined
+        fits_masters = []
+        for date_dir in ['*/*/*', '*/*/*/*']:
+            search_str = '{}/{}/{}/{}_????????*.fits*'.format(set_blackbox.red_dir,
+                                                              date_dir, imtype, imtype)
+            fits_masters += glob.glob(search_str)
+        for fits_master in fits_masters:
+            if os.path.islink(fits_master):
+                continue
+            # names are [imtype]_[date_eve].fits for biases and
+            # [imtype]_[date_eve]_[filt].fits for flats
+            name = fits_master.split('/')[-1].split('.fits')[0].split('_')
+            date_eve = name[1]
+            if imtype == 'flat' and len(name) == 3:
+                filt = name[2]
+            elif imtype == 'bias' and len(name) == 2:
+                filt = ''
+            else:
+                continue
+            try:
+                rows.append((fits_master, imtype, filt, date_eve, date2mjd(date_eve)))
+            except ValueError:
+                continue
+
+    conn = cal_index_connect()
+    try:
+        paths_gone = [(path,) for (path,) in conn.execute('SELECT path FROM masters')
+                      if not os.path.isfile(path)]
+        with conn:
+            conn.executemany('DELETE FROM masters WHERE path=?', paths_gone)
+            conn.executemany('INSERT OR REPLACE INTO masters VALUES (?, ?, ?, ?, ?)',
+                             rows)
+            conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                         ('scanned', dt.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')))
+    finally:
+        conn.close()
+
+    print ('calibration index {} rebuilt with {} masters'
+           .format(set_blackbox.cal_index, len(rows)))
 
-    else:
-        return None
-    
 
 ################################################################################
 
@@ -1427,6 +2636,216 @@ def set_header(header, filename):
     return header
 
     
+################################################################################
+
+def reduce_fused (data, header, fits_mbias, fits_mflat, date_eve, filt):
+
+    """Function that reduces the raw object image [data] in a single
+       pass through the image using [fused_corr], after which the
+       initial mask is created with [mask_init]. The result, the
+       reduced image, the initial mask and its header, is the same as
+       that of [gain_corr], [xtalk_corr], [os_corr], [master_corr]
+       using master bias [fits_mbias], [mask_init] and [master_corr]
+       using master flat [fits_mflat] applied one after the other,
+       while [data] is left untouched. [header] is updated with the
+       same keywords as these functions.
+
+    """
+
+    if set_zogy.timing:
+        t = time.time()
+
+    log.info('reading master bias and flat')
+    mbias, mbias_name = read_master(fits_mbias, 'bias', date_eve, filt)
+    mflat, mflat_name = read_master(fits_mflat, 'flat', date_eve, filt)
+
+    # reduced image shape
+    ysize_out = set_blackbox.ysize - set_blackbox.ny * set_blackbox.os_ysize
+    xsize_out = set_blackbox.xsize - set_blackbox.nx * set_blackbox.os_xsize
+    data_bpm, fits_bpm = get_bpm((ysize_out, xsize_out), filt=filt, date_eve=date_eve)
+    bpm_header(header, fits_bpm)
+
+    data_out, mask_infnan, mask_sat = fused_corr(data, header, mbias, mflat,
+                                                 data_bpm)
+
+    for imtype, master_name in [('bias', mbias_name), ('flat', mflat_name)]:
+        header['M{}-F'.format(imtype.upper())] = (
+            master_name.split('/')[-1], 'name of master {} applied'.format(imtype))
+
+    data_mask, header_mask = mask_init(data_out, header, data_mask=data_bpm,
+                                       mask_infnan=mask_infnan, mask_sat=mask_sat)
+    del mask_infnan, mask_sat
+
+    # edge pixels were excluded from the flat division in
+    # [fused_corr] unless they are saturated, but [master_corr] only
+    # excludes pixels of which the mask value is equal to that of
+    # edge pixels, so edge pixels connected to saturated pixels
+    # still need to be divided by the flat
+    value = set_zogy.mask_value['edge'] + set_zogy.mask_value['saturated-connected']
+    index = np.nonzero(data_mask == value)
+    flat_temp = mflat[index]
+    mask_ok = (flat_temp != 0)
+    data_out[index[0][mask_ok], index[1][mask_ok]] /= flat_temp[mask_ok]
+
+    if set_zogy.timing:
+        log_timing_memory (t0=t, label='reduce_fused', log=log)
+
+    return data_out, data_mask, header_mask
+
+
+################################################################################
+
+def fused_corr (data, header, mbias=None, mflat=None, data_bpm=None,
+                xtalk=True):
+
+    """Function that corrects the raw image [data] for the gain,
+       crosstalk (if [xtalk] is True) and overscan, subtracts the
+       master bias [mbias] and divides by the master flat [mflat],
+       processing blocks of [set_blackbox.fused_nrows] rows of all
+       channels at a time. The result is written directly into the
+       reduced image without overscan sections, which is returned
+       together with the boolean masks of non-finite pixels (which
+       are set to zero, after the bias subtraction) and of saturated
+       pixels before the flat division. Pixels that are edge pixels in
+       the bad pixel mask [data_bpm] and are not saturated are not
+       divided by the flat. [data] is left untouched.
+
+       The arithmetic is identical to that of the separate steps; the
+       overscan statistics are determined from the overscan sections
+       corrected for gain and crosstalk before the data sections are
+       processed.
+
+    """
+
+    if set_zogy.timing:
+        t = time.time()
+
+    ny, nx = set_blackbox.ny, set_blackbox.nx
+    nchans = ny * nx
+    nrows = set_blackbox.fused_nrows
+
+    gain_arr, gain_cards = get_gain_arr()
+    gain_chan = gain_arr.reshape(nchans, 1, 1)
+    if xtalk:
+        matrix = get_xtalk_matrix(set_blackbox.crosstalk_file)
+        i_victims, i_sources = np.nonzero(matrix)
+
+    data_view = chan_view(data)
+
+    def corr_block (y1, y2, x1, x2):
+        # returns a copy of the rows [y1:y2] and columns [x1:x2] of all
+        # channels of [data], relative to the channel origin, with
+        # shape (nchans, y2-y1, x2-x1), corrected for the gain and
+        # crosstalk in the same way as [gain_corr] and [xtalk_corr]
+        block = (data_view[:,y1:y2,:,x1:x2].transpose(0,2,1,3).copy()
+                 .reshape(nchans, y2-y1, x2-x1))
+        block *= gain_chan
+        if xtalk:
+            block_src = np.copy(block)
+            for i_victim, i_source in zip(i_victims, i_sources):
+                block[i_victim] -= block_src[i_source] * matrix[i_victim, i_source]
+        return block
+
+    def corr_sec (sec):
+        # returns list of the sections [sec] of all channels, corrected
+        # by [corr_block]
+        sec_corr = [None] * nchans
+        sec_local = [local_sec(sec, i_chan) for i_chan in range(nchans)]
+        for (y1, y2, x1, x2) in set(sec_local):
+            block = np.empty((nchans, y2-y1, x2-x1), dtype='float32')
+            for r1 in range(y1, y2, nrows):
+                r2 = min(r1+nrows, y2)
+                block[:,r1-y1:r2-y1] = corr_block(r1, r2, x1, x2)
+            for i_chan in range(nchans):
+                if sec_local[i_chan] == (y1, y2, x1, x2):
+                    sec_corr[i_chan] = block[i_chan]
+        return sec_corr
+
+    # overscan statistics
+    data_vos = corr_sec(set_blackbox.os_sec_vert)
+    data_hos = np.stack(corr_sec(set_blackbox.os_sec_hori))
+    mean_vos, std_vos, oscan = os_stats(data_vos, data_hos)
+    del data_vos, data_hos
+
+    # initialize output arrays (without overscan sections)
+    ysize_out = set_blackbox.ysize - ny * set_blackbox.os_ysize
+    xsize_out = set_blackbox.xsize - nx * set_blackbox.os_xsize
+    data_out = np.zeros((ysize_out, xsize_out), dtype='float32')
+    mask_infnan = np.zeros((ysize_out, xsize_out), dtype=bool)
+    mask_sat = np.zeros((ysize_out, xsize_out), dtype=bool)
+
+    satlevel_electrons = set_blackbox.satlevel*np.mean(set_blackbox.gain)
+    value_edge = set_zogy.mask_value['edge']
+
+    # loop blocks of rows covering the data sections of all channels
+    data_sec_red = set_blackbox.data_sec_red
+    sec_local = [local_sec(set_blackbox.data_sec, i_chan) for i_chan in range(nchans)]
+    y1_all, y2_all, x1_all, x2_all = (min([sec[0] for sec in sec_local]),
+                                      max([sec[1] for sec in sec_local]),
+                                      min([sec[2] for sec in sec_local]),
+                                      max([sec[3] for sec in sec_local]))
+    for r1 in range(y1_all, y2_all, nrows):
+        r2 = min(r1+nrows, y2_all)
+        block = corr_block(r1, r2, x1_all, x2_all)
+
+        for i_chan in range(nchans):
+
+            # rows of this block inside the data section of the channel
+            y1, y2, x1, x2 = sec_local[i_chan]
+            b1, b2 = max(r1, y1), min(r2, y2)
+            if b1 >= b2:
+                continue
+            data_chan = block[i_chan, b1-r1:b2-r1, x1-x1_all:x2-x1_all]
+
+            # corresponding section in the reduced image
+            y_out = data_sec_red[i_chan][0].start + b1 - y1
+            sec_out = (slice(y_out, y_out+b2-b1), data_sec_red[i_chan][1])
+
+            data_chan -= oscan[i_chan]
+            if mbias is not None:
+                data_chan -= mbias[sec_out]
+
+            mask_temp = ~np.isfinite(data_chan)
+            data_chan[mask_temp] = 0
+            mask_infnan[sec_out] = mask_temp
+            mask_temp = (data_chan >= satlevel_electrons)
+            mask_sat[sec_out] = mask_temp
+
+            if mflat is not None:
+                flat_chan = mflat[sec_out]
+                mask_ok = (flat_chan != 0)
+                if data_bpm is not None:
+                    mask_ok &= ((data_bpm[sec_out] != value_edge) | mask_temp)
+                data_chan[mask_ok] /= flat_chan[mask_ok]
+
+            data_out[sec_out] = data_chan
+
+
+    # header keywords of [gain_corr] and [os_corr]
+    header.extend(gain_cards, update=True)
+    os_header(header, mean_vos, std_vos)
+
+    if set_zogy.timing:
+        log_timing_memory (t0=t, label='fused_corr', log=log)
+
+    return data_out, mask_infnan, mask_sat
+
+
+################################################################################
+
+def local_sec (sec, i_chan):
+
+    """Function that returns the section [sec] (one of the sections of
+       all channels defined in [set_blackbox]) of channel [i_chan] as
+       the tuple (y1, y2, x1, x2) relative to the origin of that
+       channel."""
+
+    y0 = set_blackbox.chan_sec[i_chan][0].start
+    x0 = set_blackbox.chan_sec[i_chan][1].start
+    return (sec[i_chan][0].start-y0, sec[i_chan][0].stop-y0,
+            sec[i_chan][1].start-x0, sec[i_chan][1].stop-x0)
+
+
 ################################################################################
 
 def os_corr(data, header):
@@ -1436,59 +2855,119 @@ def os_corr(data, header):
        different data/overscan/channel sections are taken from
        [set_blackbox].  The function returns a data array that consists of
        the data sections only, i.e. without the overscan regions. The
-       [header] is update in plac.
+       [header] is updated in place.
+
+       The overscan strips of all channels are stacked so that the
+       sigma clipping is done in a single call for the vertical and
+       horizontal strips each, and the running mean of the horizontal
+       overscan is subtracted as a broadcast row. If
+       [set_blackbox.chan_parallel] is True, the channels are instead
+       processed separately on the thread pool of [chan_map].
 
     """
  
     if set_zogy.timing:
         t = time.time()
 
-    chan_sec = set_blackbox.chan_sec
     data_sec = set_blackbox.data_sec
     os_sec_hori = set_blackbox.os_sec_hori
     os_sec_vert = set_blackbox.os_sec_vert
     data_sec_red = set_blackbox.data_sec_red
     
-    # PMV 2018/08/01: this is a constant used inside the loop
+    # initialize output data array (without overscan sections)
+    ysize_out = set_blackbox.ysize - set_blackbox.ny * set_blackbox.os_ysize
+    xsize_out = set_blackbox.xsize - set_blackbox.nx * set_blackbox.os_xsize
+    data_out = np.zeros((ysize_out, xsize_out), dtype='float32')
+
+    nchans = np.shape(data_sec)[0]
+
+    if set_blackbox.chan_parallel:
+
+        # determine the overscan statistics and correct the data
+        # section for each channel separately on the thread pool
+        def os_chan (i_chan):
+            mean_vos, std_vos, oscan = os_stats(
+                [data[os_sec_vert[i_chan]]],
+                data[os_sec_hori[i_chan]][np.newaxis])
+            np.subtract(data[data_sec[i_chan]], oscan[0],
+                        out=data_out[data_sec_red[i_chan]])
+            return mean_vos[0], std_vos[0]
+        mean_vos, std_vos = np.array(chan_map(os_chan, nchans)).T
+
+    else:
+
+        # vertical overscan sections of all channels, and horizontal
+        # overscan sections stacked into an array with shape (nchans,
+        # nrows_os, ncols)
+        data_vos = [data[os_sec_vert[i_chan]] for i_chan in range(nchans)]
+        data_hos = np.stack([data[os_sec_hori[i_chan]] for i_chan in range(nchans)])
+        mean_vos, std_vos, oscan = os_stats(data_vos, data_hos)
+
+        # subtract horizontal overscan row from the data section and
+        # write the result directly into [data_out]
+        for i_chan in range(nchans):
+            np.subtract(data[data_sec[i_chan]], oscan[i_chan],
+                        out=data_out[data_sec_red[i_chan]])
+
+    os_header(header, mean_vos, std_vos)
+        
+    if set_zogy.timing:
+        log_timing_memory (t0=t, label='os_corr', log=log)
+
+    return data_out
+
+
+################################################################################
+
+def os_stats (data_vos, data_hos):
+
+    """Function that determines the clipped mean and standard
+       deviation of the vertical overscan sections of all channels,
+       the list [data_vos], and the running
+       clipped mean of the columns of the horizontal overscan sections
+       [data_hos] with shape (nchans, nrows_os, ncols), to be
+       subtracted from each row of the channel data sections. Returns
+       [mean_vos], [std_vos] and the horizontal overscan [oscan] with
+       shape (nchans, ncols).
+
+    """
+
+    # PMV 2018/08/01: width of the running mean
     dcol = 11 # after testing, 21 seems a decent width to use
 
-    # number of data columns and rows in the channel
-    ncols = set_blackbox.dx - set_blackbox.os_xsize
-    nrows = set_blackbox.dy - set_blackbox.os_ysize
+    # clipped mean (not median!) and standard deviation of the
+    # vertical overscan of each channel; these are determined with
+    # [clipped_stats] like the other image statistics, so that the
+    # header keywords BIASMn, RDNn, BIASMEAN and RDNOISE are not
+    # affected by the vectorization of the horizontal overscan
+    mean_vos, std_vos = np.array([clipped_stats(data_chan, get_median=False)
+                                  for data_chan in data_vos]).T
 
-    # initialize output data array (without overscan sections)
-    ysize_out = set_blackbox.ysize - set_blackbox.ny * set_blackbox.os_ysize
-    xsize_out = set_blackbox.xsize - set_blackbox.nx * set_blackbox.os_xsize
-    data_out = np.zeros((ysize_out, xsize_out), dtype='float32')
+    # clipped mean of each column of the horizontal overscan; the
+    # clipping is done independently for each channel and column,
+    # identical to clipping the channels one by one
+    mean_hos, __, __ = sigma_clipped_stats(data_hos, axis=1)
 
-    # and arrays to calculate average means and stds over all channels
-    nchans = np.shape(data_sec)[0]
-    mean_vos = np.zeros(nchans)
-    std_vos = np.zeros(nchans)
+    # running mean of the horizontal overscan using all values
+    # across [dcol] columns; the window is truncated at the edges
+    oscan = running_mean(mean_hos, dcol)
+    # do not use the running mean for the first column
+    oscan[:,0] = mean_hos[:,0]
 
-    for i_chan in range(nchans):
+    return mean_vos, std_vos, oscan
 
-        # first subtract the clipped mean (not median!) of the
-        # vertical overcan section from the entire channel
-        data_vos = data[os_sec_vert[i_chan]]
-        mean_vos[i_chan], std_vos[i_chan] = clipped_stats(data_vos, get_median=False)
-        #data[chan_sec[i_chan]] -= mean_vos[i_chan]
-                
-        # determine the running clipped mean of the overscan using all
-        # values across [dcol] columns, for [ncols] columns
-        data_hos = data[os_sec_hori[i_chan]]
-        mean_hos, median_hos, std_hos = sigma_clipped_stats(data_hos, axis=0)
-        oscan = [np.mean(mean_hos[max(k-int(dcol/2.),0):min(k+int(dcol/2.)+1,ncols)])
-                 for k in range(ncols)]
-        # do not use the running mean for the first column
-        oscan[0] = mean_hos[0]
-        # subtract horizontal overscan 
-        data[data_sec[i_chan]] -= np.vstack([oscan]*nrows)
-        # broadcast into [data_out]
-        data_out[data_sec_red[i_chan]] = data[data_sec[i_chan]] 
-
-
-    # add headers outside above loop to make header more readable
+
+################################################################################
+
+def os_header (header, mean_vos, std_vos):
+
+    """Function that adds the vertical overscan statistics of the
+       channels to [header]."""
+
+    nchans = np.shape(mean_vos)[0]
+
+    # add the means and standard deviations in separate loops to
+    # make header more readable
     for i_chan in range(nchans):
         header['BIASM{}'.format(i_chan+1)] = (
             mean_vos[i_chan], '[e-] channel {} mean vertical overscan'.format(i_chan+1))
@@ -1500,32 +2979,115 @@ def os_corr(data, header):
     # determined for each channel to the header
     header['BIASMEAN'] = (np.mean(mean_vos), '[e-] average all channel means vert. overscan')
     header['RDNOISE'] = (np.mean(std_vos), '[e-] average all channel sigmas vert. overscan')
-        
-    if set_zogy.timing:
-        log_timing_memory (t0=t, label='os_corr', log=log)
 
-    return data_out
+    return
+
+
+################################################################################
+
+def running_mean (array, width):
+
+    """Function that returns the running mean of [array] along its last
+       axis, over the window from [width]/2 elements before to
+       [width]/2 elements after each element. Near the edges the
+       window is truncated, i.e. the mean is taken over the available
+       elements only. The windows that are not truncated are averaged
+       at once using a strided view of [array], with the same
+       summation as np.mean applied to each window separately.
+
+    """
+
+    array = np.ascontiguousarray(array)
+    n = np.shape(array)[-1]
+    half = int(width/2)
+
+    mean = np.empty_like(array)
+
+    # view with shape (..., n-2*half, 2*half+1) of the windows that
+    # are completely inside [array]
+    strides = array.strides
+    windows = np.lib.stride_tricks.as_strided(
+        array, shape=np.shape(array)[:-1]+(n-2*half, 2*half+1),
+        strides=strides+strides[-1:])
+    mean[...,half:n-half] = np.mean(windows, axis=-1)
+
+    # truncated windows at the edges
+    for k in list(range(half)) + list(range(n-half, n)):
+        mean[...,k] = np.mean(array[...,max(k-half,0):min(k+half+1,n)], axis=-1)
+
+    return mean
+
+
+################################################################################
+
+def get_xtalk_matrix (crosstalk_file):
+
+    """Function that reads the crosstalk coefficients in
+       [crosstalk_file] into a (nchans, nchans) float32 matrix, where
+       element [i_victim, i_source] is the fraction of the source
+       channel that is subtracted from the victim channel. The channel
+       indices are the same as those used for [set_blackbox.gain] and
+       the channel sections. The file is read only once per process.
+
+    """
+
+    if crosstalk_file not in xtalk_matrix:
+
+        victim, source, correction = np.loadtxt(crosstalk_file, unpack=True)
+
+        # convert the channel numbers in [crosstalk_file] to the
+        # channel indices, see N.B. in [xtalk_corr]
+        nx = set_blackbox.nx
+        def chan_index (chan_number):
+            chan_number = chan_number.astype(int)
+            return np.where(chan_number <= nx, nx, 0) + (chan_number-1) % nx
+
+        nchans = set_blackbox.ny * nx
+        matrix = np.zeros((nchans, nchans), dtype='float32')
+        np.add.at(matrix, (chan_index(victim), chan_index(source)), correction)
+        xtalk_matrix[crosstalk_file] = matrix
+
+    return xtalk_matrix[crosstalk_file]
+
+
+# crosstalk matrices read by [get_xtalk_matrix], with the crosstalk
+# file name as key
+xtalk_matrix = {}
 
 
 ################################################################################
 
 def xtalk_corr (data, crosstalk_file):
 
-    # basically the same as Kerry's function
-        
+    """Function that corrects the raw image [data] in place for the
+       crosstalk between channels, using the coefficient matrix
+       returned by [get_xtalk_matrix]. The correction is done in
+       blocks of [set_blackbox.xtalk_nrows] rows of all channels at
+       once; for each block the uncorrected source channels are
+       saved first, so that a channel that has already been
+       corrected is not used as a source. The result is identical
+       to that of [xtalk_corr_ref].
+
+    """
+
     if set_zogy.timing:
         t = time.time()
 
-    victim, source, correction = np.loadtxt(crosstalk_file,unpack=True)
-    corrected = []
-    #data = data[0]
-    height,width = set_blackbox.dy, set_blackbox.dx # = ccd_sec()
-    for k in range(len(victim)):
-        if victim[k] < 9:
-            j, i = 1, 0
-        else:
-            j, i = 0, 8
-        data[height*j:height*(j+1),width*(int(victim[k])-1-i):width*(int(victim[k])-i)] -= data[height*j:height*(j+1),width*(int(source[k])-1-i):width*(int(source[k])-i)]*correction[k]
+    matrix = get_xtalk_matrix(crosstalk_file)
+    i_victims, i_sources = np.nonzero(matrix)
+
+    data_view = chan_view(data)
+    ny, dy, nx, dx = data_view.shape
+    nrows = set_blackbox.xtalk_nrows
+    for y1 in range(0, dy, nrows):
+        y2 = min(y1+nrows, dy)
+        # uncorrected rows [y1:y2] of all channels, with shape
+        # (nchans, y2-y1, dx)
+        data_src = (data_view[:,y1:y2].transpose(0,2,1,3).copy()
+                    .reshape(ny*nx, y2-y1, dx))
+        for i_victim, i_source in zip(i_victims, i_sources):
+            data_view[i_victim//nx, y1:y2, i_victim%nx] -= (
+                data_src[i_source] * matrix[i_victim, i_source])
 
     if set_zogy.timing:
         log_timing_memory (t0=t, label='xtalk_corr', log=log)
@@ -1566,24 +3128,143 @@ def xtalk_corr (data, crosstalk_file):
     # 15 0 5300 9000 10500
     # 16 0 5300 10500 12000
 
+
+################################################################################
+
+def xtalk_corr_ref (data, crosstalk_file):
+
+    """Straightforward reference implementation of [xtalk_corr] that
+       subtracts the full source channels of a copy of the uncorrected
+       [data] from the victim channels. It uses twice the memory of
+       [xtalk_corr] but should give bit-for-bit the same result, e.g.:
+
+       np.array_equal(xtalk_corr(data.copy(), crosstalk_file),
+                      xtalk_corr_ref(data.copy(), crosstalk_file))
+
+    """
+
+    matrix = get_xtalk_matrix(crosstalk_file)
+    nx = set_blackbox.nx
+
+    data_view = chan_view(data)
+    data_src = chan_view(np.copy(data))
+    for i_victim, i_source in zip(*np.nonzero(matrix)):
+        data_view[i_victim//nx, :, i_victim%nx] -= (
+            data_src[i_source//nx, :, i_source%nx] * matrix[i_victim, i_source])
+
+    return data
+
     
 ################################################################################
 
-def gain_corr(data, header):
+def get_gain_arr():
 
-    if set_zogy.timing:
-        t = time.time()
+    """Function that returns the gain array with shape (ny, 1, nx, 1)
+       and the corresponding list of header cards, both defined by
+       [set_blackbox.gain]. These are prepared only once per process;
+       subsequent calls return the same objects.
 
-    """Returns [data] corrected for the [gain] defined in [set_blackbox.gain]
-       for the different channels
+    """
+
+    global gain_arr_cards
+    if gain_arr_cards is None:
+
+        gain = set_blackbox.gain
+        ny, nx = set_blackbox.ny, set_blackbox.nx
+        # the gain indices run along x first, i.e. channel
+        # [i_chan] is located at (i_chan // nx, i_chan % nx); float32
+        # so that the multiplication is done in single precision,
+        # identical to multiplying with the individual gain values
+        gain_arr = np.array(gain, dtype='float32').reshape(ny, 1, nx, 1)
+        gain_cards = [('GAIN{}'.format(i_chan+1), gain[i_chan],
+                       'gain applied to channel {}'.format(i_chan+1))
+                      for i_chan in range(ny*nx)]
+        gain_arr_cards = (gain_arr, gain_cards)
+
+    return gain_arr_cards
+
+
+# gain array and header cards, see [get_gain_arr]
+gain_arr_cards = None
+
+
+################################################################################
+
+def chan_map (func, nchans):
+
+    """Function that returns the list of results of [func] applied to
+       the channel indices 0 to [nchans]-1. If
+       [set_blackbox.chan_parallel] is True, the channels are processed
+       in parallel on a pool of [set_blackbox.nthread] threads, which
+       is created once per process; otherwise they are processed one
+       after the other. The pool is only effective for functions that
+       spend most of their time in numpy operations that release the
+       GIL.
+
+    """
+
+    if set_blackbox.chan_parallel:
+
+        global chan_pool
+        # the pool is not inherited by the processes of
+        # [run_blackbox]'s multiprocessing pool, so check the process ID
+        if chan_pool is None or chan_pool[0] != os.getpid():
+            chan_pool = (os.getpid(), ThreadPool(set_blackbox.nthread))
+
+        return chan_pool[1].map(func, range(nchans))
+
+    else:
+        return [func(i_chan) for i_chan in range(nchans)]
+
+
+# process ID and thread pool used by [chan_map]
+chan_pool = None
+
+
+################################################################################
+
+def chan_view(data):
+
+    """Function that returns a view of the raw image [data] with shape
+       (ny, dy, nx, dx), so that the channel with index [i_chan]
+       corresponds to [i_chan // nx, :, i_chan % nx, :]. Setting the
+       shape attribute raises an exception rather than silently
+       returning a copy if [data] cannot be viewed in this way.
+
+    """
+
+    data_view = data.view()
+    data_view.shape = (set_blackbox.ny, set_blackbox.dy,
+                       set_blackbox.nx, set_blackbox.dx)
+    return data_view
+
+
+################################################################################
+
+def gain_corr(data, header):
+
+    """Returns [data] corrected for the [gain] defined in
+       [set_blackbox.gain] for the different channels. The gain is
+       applied to all channels in a single broadcast multiplication
+       on the (ny, dy, nx, dx) view of [data], or channel by channel
+       on the thread pool of [chan_map] if
+       [set_blackbox.chan_parallel] is True.
 
     """
 
-    gain = set_blackbox.gain
-    chan_sec = set_blackbox.chan_sec
-    for i_chan in range(np.shape(chan_sec)[0]):
-        data[chan_sec[i_chan]] *= gain[i_chan]
-        header['GAIN{}'.format(i_chan+1)] = (gain[i_chan], 'gain applied to channel {}'.format(i_chan+1))
+    if set_zogy.timing:
+        t = time.time()
+
+    gain_arr, gain_cards = get_gain_arr()
+    data_view = chan_view(data)
+    if set_blackbox.chan_parallel:
+        nx = set_blackbox.nx
+        def gain_chan (i_chan):
+            data_view[i_chan//nx, :, i_chan%nx] *= gain_arr[i_chan//nx, 0, i_chan%nx, 0]
+        chan_map(gain_chan, np.size(gain_arr))
+    else:
+        data_view *= gain_arr
+    header.extend(gain_cards, update=True)
 
     if set_zogy.timing:
         log_timing_memory (t0=t, label='gain_corr', log=log)
@@ -1622,6 +3303,59 @@ def gain_corr(data, header):
     # 5300 10600 10500 12000 15
 
 
+################################################################################
+
+def bench_chan_parallel (nloop=3):
+
+    """Function that compares the timing of the gain and overscan
+       corrections of a simulated raw image with
+       [set_blackbox.chan_parallel] False (serial) and True
+       (channel-parallel on [set_blackbox.nthread] threads), and
+       checks that both give the same reduced image and header. It
+       returns a dictionary with the best time out of [nloop] runs of
+       each mode. Can be run with e.g.:
+
+       python -c 'import blackbox; blackbox.bench_chan_parallel()'
+
+    """
+
+    global log
+    if 'log' not in globals():
+        log = logging.getLogger()
+
+    data_raw = np.random.RandomState(1).normal(
+        1000., 5., (set_blackbox.ysize, set_blackbox.xsize)).astype('float32')
+
+    chan_parallel_orig = set_blackbox.chan_parallel
+    timing = {}
+    result = {}
+    try:
+        for mode in ['serial', 'parallel']:
+            set_blackbox.chan_parallel = (mode=='parallel')
+            t_loop = []
+            for i_loop in range(nloop):
+                data = np.copy(data_raw)
+                header = fits.Header()
+                t = time.time()
+                data = gain_corr(data, header)
+                data = os_corr(data, header)
+                t_loop.append(time.time()-t)
+            timing[mode] = min(t_loop)
+            result[mode] = (data, header)
+    finally:
+        set_blackbox.chan_parallel = chan_parallel_orig
+
+    data_equal = np.array_equal(result['serial'][0], result['parallel'][0])
+    header_equal = all([result['serial'][1][key] == result['parallel'][1][key]
+                        for key in result['serial'][1]])
+    print ('gain and overscan correction with {} threads; serial: {:.3f}s, '
+           'parallel: {:.3f}s, identical image: {}, identical header: {}'
+           .format(set_blackbox.nthread, timing['serial'], timing['parallel'],
+                   data_equal, header_equal))
+
+    return timing
+
+
 ################################################################################
 
 def get_path (telescope, date, dir_type):
@@ -1705,16 +3439,13 @@ def sort_files(read_path, file_name):
     """
        
     all_files = sorted(glob.glob(read_path+'/'+file_name)) #glob all raw files and sort
+    headers = scan_headers(all_files) #read all headers at once
     bias = [] #list of biases
     flat = [] #list of flats
     science = [] # list of science images
     for i in range(len(all_files)): #loop through raw files
 
-        if '.fz' not in all_files[i]:
-            header = read_hdulist(all_files[i], ext_header=0)
-        else:
-            header = read_hdulist(all_files[i], ext_header=1)
-
+        header = headers[i]
         imgtype = header['IMAGETYP'].lower() #get image type
         
         if 'bias' in imgtype: #add bias files to bias list
@@ -1730,29 +3461,259 @@ def sort_files(read_path, file_name):
 
 ################################################################################
 
-def unzip(imgname, timeout=None):
+def read_header_raw (filename):
+
+    """Function that returns the header of raw image [filename], which
+       is in the first extension if the image is fpacked; see
+       [scan_headers]."""
+
+    return scan_headers([filename])[0]
+
+
+################################################################################
+
+def scan_headers (filenames):
+
+    """Function that returns the list of headers of the raw images
+       [filenames] (of the first extension for fpacked images). The
+       headers are taken from the header cache [set_blackbox.header_cache]
+       if the size and modification time of the image did not change
+       since it was cached; the other headers are read with
+       [parse_header_raw] on [set_blackbox.nthread] threads and added
+       to the cache.
 
-    """Unzip a gzipped of fpacked file.
-       Same [subpipe] function STAP_unzip.
     """
 
-    #lock.acquire()
+    if set_zogy.timing:
+        t = time.time()
 
-    if '.gz' in imgname:
-        print ('gunzipping {}'.format(imgname))
-        subprocess.call(['gunzip',imgname])
-        imgname = imgname.replace('.gz','')
-    elif '.fz' in imgname:
-        print ('funpacking {}'.format(imgname))
-        subprocess.call(['funpack','-D',imgname])
-        imgname = imgname.replace('.fz','')
+    headers = {}
+    file_stat = {}
+    for filename in filenames:
+        stat = os.stat(filename)
+        file_stat[filename] = (stat.st_size, stat.st_mtime)
 
-    #lock.release()
+    conn = None
+    if set_blackbox.header_cache is not None:
+        conn = header_cache_connect()
+
+    try:
+
+        if conn is not None:
+            for filename in filenames:
+                row = conn.execute('SELECT size, mtime, header FROM headers '
+                                   'WHERE path=?', (filename,)).fetchone()
+                if row is not None and (row[0], row[1]) == file_stat[filename]:
+                    headers[filename] = fits.Header.fromstring(row[2])
+
+        filenames_scan = [filename for filename in filenames
+                          if filename not in headers]
+        if len(filenames_scan) > 0:
+
+            nthread = min(set_blackbox.nthread, len(filenames_scan))
+            if nthread > 1:
+                pool = ThreadPool(nthread)
+                headers_scan = pool.map(parse_header_raw, filenames_scan)
+                pool.close()
+                pool.join()
+            else:
+                headers_scan = [parse_header_raw(filename)
+                                for filename in filenames_scan]
+
+            for filename, header in zip(filenames_scan, headers_scan):
+                headers[filename] = header
+
+            if conn is not None:
+                with conn:
+                    conn.executemany(
+                        'INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?)',
+                        [(filename, file_stat[filename][0], file_stat[filename][1],
+                          headers[filename].tostring())
+                         for filename in filenames_scan])
+
+    finally:
+        if conn is not None:
+            conn.close()
+
+    if set_zogy.timing and len(filenames) > 1:
+        print ('scanned {} headers ({} from cache) in {:.3f}s'
+               .format(len(filenames), len(filenames)-len(filenames_scan),
+                       time.time()-t))
+
+    return [headers[filename] for filename in filenames]
+
+
+################################################################################
+
+def parse_header_raw (filename):
+
+    """Function that reads the header of raw image [filename] (of the
+       first extension if it is fpacked) directly from the 2880-byte
+       FITS header blocks, without reading the data. For fpacked
+       images this is the header of the binary table holding the
+       compressed image, which contains the same keywords as the
+       image header apart from those describing the image structure.
+
+    """
+
+    if '.fz' in filename:
+        ext = 1
+    else:
+        ext = 0
+
+    if '.gz' in filename:
+        f = gzip.open(filename, 'rb')
+    else:
+        f = open(filename, 'rb')
+
+    with f:
+        for i_ext in range(ext+1):
+
+            # read header blocks up to and including the one with the
+            # END card
+            blocks = []
+            while True:
+                block = f.read(2880)
+                if len(block) < 2880:
+                    raise IOError('no END card found in header of extension {} '
+                                  'of {}'.format(i_ext, filename))
+                blocks.append(block)
+                if any([block[i:i+80].rstrip() == b'END'
+                        for i in range(0, 2880, 80)]):
+                    break
+
+            header = fits.Header.fromstring(b''.join(blocks).decode('ascii'))
+
+            if i_ext < ext:
+                # skip the data of this extension
+                naxis = header.get('NAXIS', 0)
+                if naxis > 0:
+                    npix = 1
+                    for i_axis in range(naxis):
+                        npix *= header['NAXIS{}'.format(i_axis+1)]
+                    nbytes = (abs(header['BITPIX']) // 8 * header.get('GCOUNT', 1) *
+                              (header.get('PCOUNT', 0) + npix))
+                    f.seek(int(np.ceil(nbytes / 2880.)) * 2880, 1)
+
+    return header
+
+
+################################################################################
+
+def header_cache_connect ():
+
+    """Function that returns a connection to the SQLite header cache
+       [set_blackbox.header_cache] with the headers of the raw images,
+       keyed by file name."""
+
+    conn = sqlite3.connect(set_blackbox.header_cache, timeout=60)
+    with conn:
+        conn.execute('CREATE TABLE IF NOT EXISTS headers (path TEXT PRIMARY KEY, '
+                     'size INTEGER, mtime REAL, header TEXT)')
+
+    return conn
+
+
+################################################################################
+
+def read_fits_mem (filename, ext=0, get_header=True, dtype=None):
+
+    """Function that returns the data (converted to [dtype] if
+       provided) and header of extension [ext] of image [filename].
+       Gzipped and fpacked images are decompressed in memory; for
+       fpacked images, the compressed image in extension 1 is read
+       irrespective of [ext], and its tiles are decompressed in
+       strips of rows on [set_blackbox.decompress_nthread] threads. If
+       [get_header] is False, only the data is returned.
+
+    """
+
+    if '.fz' in filename:
+
+        with fits.open(filename) as hdulist:
+            hdu = hdulist[1]
+            header = hdu.header.copy()
+            ysize = header['NAXIS2']
+            nthread = min(set_blackbox.decompress_nthread, ysize)
+            if nthread > 1:
+                nrows = int(np.ceil(ysize / float(nthread)))
+                # each thread reads its strip through its own file
+                # handle, as reading through a shared handle is not
+                # thread-safe
+                def read_strip (y1):
+                    with fits.open(filename) as hdulist_strip:
+                        return hdulist_strip[1].section[y1:y1+nrows]
+                pool = ThreadPool(nthread)
+                data = np.concatenate(pool.map(read_strip, range(0, ysize, nrows)))
+                pool.close()
+                pool.join()
+            else:
+                data = hdu.data
+
+    elif '.gz' in filename:
+
+        # astropy decompresses gzipped files in memory
+        with fits.open(filename) as hdulist:
+            data = hdulist[ext].data
+            header = hdulist[ext].header.copy()
+
+    else:
+        data, header = read_hdulist(filename, ext_data=ext, ext_header=ext)
+
+    if dtype is not None:
+        data = data.astype(dtype)
+
+    if get_header:
+        return data, header
+    else:
+        return data
+
+
+################################################################################
+
+def write_fits (fits_out, data, header):
+
+    """Function that writes [data] and [header] to [fits_out], or, if
+       [set_blackbox.compress_output] is True, tile-compressed to
+       [fits_out].fz using the compression algorithm
+       [set_blackbox.compress_type]. Integer data, such as the mask,
+       are compressed losslessly, while floating-point data are
+       quantized with [set_blackbox.compress_quantize_level] and
+       [set_blackbox.compress_quantize_method]. Returns the name of
+       the file written.
+
+    """
+
+    if not set_blackbox.compress_output:
+        fits.writeto(fits_out, data, header, overwrite=True)
+        return fits_out
+
+    fits_out = '{}.fz'.format(fits_out)
+
+    kwargs = {}
+    if data.dtype.kind == 'f':
+        kwargs['quantize_level'] = set_blackbox.compress_quantize_level
+        kwargs['quantize_method'] = set_blackbox.compress_quantize_method
+    if set_blackbox.compress_type == 'HCOMPRESS_1':
+        kwargs['hcomp_scale'] = set_blackbox.compress_hcomp_scale
+
+    hdu = fits.CompImageHDU(data, header, compression_type=set_blackbox.compress_type,
+                            **kwargs)
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(fits_out, overwrite=True)
+
+    return fits_out
+
+
+################################################################################
+
+def isfile_fz (filename):
+
+    """Function that checks if [filename] or its fpacked version
+       [filename].fz exists."""
+
+    return os.path.isfile(filename) or os.path.isfile('{}.fz'.format(filename))
 
-    return imgname
-        
 
-    
 ################################################################################
 
 class MyLogger(object):
@@ -1876,50 +3837,663 @@ def copying(file):
 
 ################################################################################
 
-def action(item_list):
-    '''Action to take during night mode of pipeline.
+class NightQueue(object):
+    '''Schedules the raw images found in night mode over the processes
+    of [pool].
+
+    The images put on the queue wait in a pending list and are
+    submitted to [pool] one at a time per free process, in the order
+    set by [set_blackbox.night_policy]:
+
+    - 'fifo': in order of arrival
+    - 'newest': object images first, the most recent (DATE-OBS) first,
+      followed by the calibration frames in order of arrival
+    - 'calib_first': bias and flat frames first, followed by the
+      object images, both in order of arrival
+    - 'deadline': earliest deadline first, where the deadline is the
+      arrival time plus the latency allowed for the field (OBJECT) in
+      [set_blackbox.night_deadline]; images past their deadline go
+      after the ones that can still make it
+
+    Whatever the policy, an object image is held until the bias frames
+    of its evening date and the flats of its date and filter that are
+    on the queue have been reduced, as the masters built from them are
+    not rebuilt once they exist.
+
+    If more than [set_blackbox.night_depth] images are pending, the
+    lowest-ranked object image is deferred to a backlog that is only
+    processed when no other images can be submitted, so that a backlog
+    built up during a stall does not hold up the new images; bias and
+    flat frames are never deferred. The queue state and metrics are
+    written to [set_blackbox.night_state_file].
+
+    :param pool: pool of processes that reduce the images
+    :type pool: multiprocessing.Pool'''
+
+    def __init__(self, pool, telescope):
+        self._pool = pool
+        self._telescope = telescope
+        self._policy = set_blackbox.night_policy
+        self._depth = set_blackbox.night_depth
+        if self._policy not in ['fifo', 'newest', 'calib_first', 'deadline']:
+            q.put(logger.error('unknown [night_policy] {}; using fifo'
+                               .format(self._policy)))
+            self._policy = 'fifo'
+        self._state_file = set_blackbox.night_state_file
+        if self._state_file is not None:
+            self._state_file = self._state_file.format(telescope)
+        self._lock = threading.Lock()
+        self._pending = []
+        self._backlog = []
+        self._running = {}
+        self._nseq = 0
+        self._t_state = 0
+        self._metrics = {'received': 0, 'done': 0, 'failed': 0,
+                         'deferred': 0, 'max_pending': 0,
+                         'wait_mean': 0., 'wait_max': 0.,
+                         'latency_last': 0., 'latency_mean': 0.,
+                         'latency_max': 0.}
+
+    def put(self, item):
+        '''Add [item], the list of arguments of [blackbox_reduce], to the
+        pending images.'''
+        filename = item[0]
+        t_now = time.time()
+        try:
+            header = read_header_raw(filename)
+            imgtype = header['IMAGETYP'].lower()
+            obj = get_obj(header) if 'object' in imgtype else None
+            __, date_eve = get_path(self._telescope, header['DATE-OBS'], 'write')
+            filt = header['FILTER']
+            key = affinity_key(header)
+            t_obs = (dt.datetime.strptime(header['DATE-OBS'][0:19], '%Y-%m-%dT%H:%M:%S')
+                     - dt.datetime(1970,1,1)).total_seconds()
+        except Exception as e:
+            # let [blackbox_reduce] deal with it
+            q.put(logger.warn('could not read header of {}: {}'.format(filename, e)))
+            imgtype, obj, t_obs, key = 'object', None, t_now, None
+            date_eve, filt = None, None
+
+        deadline = set_blackbox.night_deadline.get(obj, set_blackbox.night_deadline['default'])
+        entry = {'item': item, 'filename': filename, 'imgtype': imgtype,
+                 'obj': obj, 't_obs': t_obs, 't_arrive': t_now, 'key': key,
+                 'date_eve': date_eve, 'filt': filt,
+                 'deadline': t_now + deadline}
+
+        with self._lock:
+            entry['seq'] = self._nseq
+            self._nseq += 1
+            self._pending.append(entry)
+            self._metrics['received'] += 1
+            objects = [e for e in self._pending if 'object' in e['imgtype']]
+            if (self._depth is not None and len(self._pending) > self._depth and
+                len(objects) > 0):
+                worst = max(objects, key=lambda e: self._rank(e, t_now))
+                self._pending.remove(worst)
+                self._backlog.append(worst)
+                self._metrics['deferred'] += 1
+                q.put(logger.info('{} images pending; deferring {} to backlog'
+                                  .format(len(self._pending), worst['filename'])))
+            self._metrics['max_pending'] = max(self._metrics['max_pending'],
+                                               len(self._pending))
+
+    def _rank(self, entry, t_now):
+        '''Return the sort key of [entry] according to the policy;
+        lowest is submitted first.'''
+        calib = 'object' not in entry['imgtype']
+        if self._policy == 'newest':
+            if calib:
+                return (1, entry['seq'])
+            return (0, -entry['t_obs'], entry['seq'])
+        elif self._policy == 'calib_first':
+            return (0 if calib else 1, entry['seq'])
+        elif self._policy == 'deadline':
+            return (entry['deadline'] < t_now, entry['deadline'], entry['seq'])
+        return (entry['seq'],)
+
+    def _blocked(self, entry, calibs):
+        '''Return True if [entry] is an object image that needs one of
+        the bias or flat frames [calibs] to be reduced first.'''
+        if 'object' not in entry['imgtype'] or entry['date_eve'] is None:
+            return False
+        for calib in calibs:
+            if (calib['date_eve'] == entry['date_eve'] and
+                ('bias' in calib['imgtype'] or
+                 ('flat' in calib['imgtype'] and calib['filt'] == entry['filt']))):
+                return True
+        return False
+
+    def _pop(self, t_now):
+        '''Remove and return the highest-ranked pending entry that is
+        not held by [_blocked], or from the backlog if there is none.'''
+        with self._lock:
+            calibs = [e for e in (self._pending + self._backlog +
+                                  [r[1] for r in self._running.values()])
+                      if 'bias' in e['imgtype'] or 'flat' in e['imgtype']]
+            for entries in [self._pending, self._backlog]:
+                entries_free = sorted([e for e in entries if not self._blocked(e, calibs)],
+                                      key=lambda e: self._rank(e, t_now))
+                if not entries_free:
+                    continue
+                # with [AffinityPool], the highest-ranked image whose
+                # worker is idle (see [AffinityPool.select])
+                n = 0
+                if set_blackbox.affinity:
+                    n = self._pool.select([(e['key'], e['t_arrive'])
+                                           for e in entries_free])
+                    if n is None:
+                        return None
+                entries.remove(entries_free[n])
+                return entries_free[n]
+            return None
+
+    def dispatch(self):
+        '''Collect the finished images and submit pending images to the
+        free processes; returns True if any images are left.'''
+        t_now = time.time()
+
+        for filename in [f for f in self._running if self._running[f][0].ready()]:
+            result, entry = self._running.pop(filename)
+            try:
+                result.get()
+            except Exception as e:
+                q.put(logger.info(traceback.format_exc()))
+                q.put(logger.error('exception was raised during [blackbox_reduce] '
+                                   'of {}: {}'.format(filename, e)))
+                self._metrics['failed'] += 1
+            latency = t_now - entry['t_arrive']
+            m = self._metrics
+            m['done'] += 1
+            m['latency_last'] = latency
+            m['latency_mean'] += (latency - m['latency_mean']) / m['done']
+            m['latency_max'] = max(m['latency_max'], latency)
+
+        while len(self._running) < set_blackbox.nproc:
+            entry = self._pop(t_now)
+            if entry is None:
+                break
+            wait = t_now - entry['t_arrive']
+            m = self._metrics
+            nstart = m['done'] + len(self._running) + 1
+            m['wait_mean'] += (wait - m['wait_mean']) / nstart
+            m['wait_max'] = max(m['wait_max'], wait)
+            if set_blackbox.affinity:
+                result = self._pool.apply_async(blackbox_reduce, entry['item'],
+                                                key=entry['key'],
+                                                t_ready=entry['t_arrive'])
+            else:
+                result = self._pool.apply_async(blackbox_reduce, entry['item'])
+            self._running[entry['filename']] = (result, entry)
+
+        if t_now - self._t_state >= 10:
+            self.write_state()
+            self._t_state = t_now
+
+        return bool(self._running or self._pending or self._backlog)
+
+    def state(self):
+        '''Return the queue state and metrics as a dictionary.'''
+        t_now = time.time()
+        with self._lock:
+            pending = sorted(self._pending, key=lambda e: self._rank(e, t_now))
+            state = {'time': dt.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
+                     'policy': self._policy, 'depth': self._depth,
+                     'npending': len(self._pending),
+                     'nbacklog': len(self._backlog),
+                     'nrunning': len(self._running),
+                     'oldest_pending_s': max([t_now - e['t_arrive'] for e in
+                                              self._pending + self._backlog] + [0]),
+                     'running': sorted(self._running.keys()),
+                     'pending': [e['filename'] for e in pending[0:20]]}
+            state.update(self._metrics)
+        if set_blackbox.affinity:
+            state['workers'] = self._pool.stats()
+        return state
+
+    def write_state(self):
+        '''Write the queue state to [set_blackbox.night_state_file].'''
+        if self._state_file is None:
+            return
+        try:
+            tmp_file = '{}.tmp'.format(self._state_file)
+            with open(tmp_file, 'w') as f:
+                json.dump(self.state(), f, indent=1)
+            os.rename(tmp_file, self._state_file)
+        except (IOError, OSError) as e:
+            q.put(logger.warn('could not write {}: {}'.format(self._state_file, e)))
 
-    For new events, continues if it is a file. '''
 
-    print ('event!') #DP: added brackets
-    
-    #get parameters for list
-    event, telescope, mode, read_path = item_list.get(True)
-    
-    while True:
-        try:
-            filename = str(event.src_path) #get name of new file
-            if 'fits' in filename: #only continue if event is a fits file
-                if '_mask' or '_red' not in filename:
-                    copying(filename) #check to see if write is finished writing
-                    q.put(logger.info('Found new file '+filename))
-        except AttributeError: #if event is a file
-            filename = event
-            q.put(logger.info('Found old file '+filename))
-            
-        blackbox_reduce (filename, telescope, mode, read_path)
+################################################################################
+
+class AffinityPool(object):
+    '''Pool of [nproc] worker processes that routes the jobs with the
+    same key (see [affinity_key]) to the same worker, so that the
+    calibration and reference files cached by a worker are reused.
+
+    The key is mapped to a worker with consistent hashing. A job waits
+    in the queue of its worker, or in a common queue if it has no key,
+    and a worker that is idle takes the oldest job from its own queue,
+    then from the common queue, and otherwise steals the oldest job
+    that waited at least [set_blackbox.affinity_steal_wait] seconds
+    in the queue of another worker. Like [multiprocessing.Pool.apply_async],
+    [apply_async] returns an object with methods [ready] and [get].
+    The cache hit rates of each worker are returned by [stats] and
+    logged by [close].
+
+    As [schedule_day] and [NightQueue] submit no more jobs than there
+    are workers, they use [select] to choose which of the jobs that
+    are ready to submit: preferably one whose worker is idle, so that
+    jobs are only stolen if they waited too long for their worker.
+
+    :param nproc: number of worker processes
+    :type nproc: int'''
+
+    def __init__(self, nproc):
+        self._nproc = nproc
+        # each worker is a pool with a single process, so that the
+        # worker a job runs on can be chosen
+        self._pools = [Pool(1) for i in range(nproc)]
+        self._queues = [[] for i in range(nproc)]
+        self._queue_any = []
+        self._running = [None] * nproc
+        self._stats = [{'jobs': 0, 'stolen': 0, 'cache': {}}
+                       for i in range(nproc)]
+        # hash ring with 64 points per worker
+        self._ring = sorted([(affinity_hash((i, j)), i) for i in range(nproc)
+                             for j in range(64)])
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._dispatch)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def home(self, key):
+        '''Return the worker of jobs with [key].'''
+        i = bisect.bisect(self._ring, (affinity_hash(key),))
+        return self._ring[i % len(self._ring)][1]
+
+    def _idle(self):
+        '''Return the list of workers that are idle and will not get
+        a job from the common queue.'''
+        idle = [i for i in range(self._nproc)
+                if self._running[i] is None and not self._queues[i]]
+        return idle[len(self._queue_any):]
+
+    def select(self, jobs):
+        '''Return the index of the job to submit next from [jobs], a
+        list of (key, time the job became ready) in order of priority:
+        the first job whose worker is idle, or else the first job that
+        waited at least [set_blackbox.affinity_steal_wait] seconds, if
+        any worker is idle; None if no job should be submitted now.'''
+        with self._lock:
+            idle = self._idle()
+        if not idle:
+            return None
+        for n, (key, t_ready) in enumerate(jobs):
+            if key is None or self.home(key) in idle:
+                return n
+        t_steal = time.time() - set_blackbox.affinity_steal_wait
+        for n, (key, t_ready) in enumerate(jobs):
+            if t_ready <= t_steal:
+                return n
+        return None
+
+    def apply_async(self, func, args=(), key=None, t_ready=None, callback=None,
+                    error_callback=None):
+        '''Run [func] with [args] on the worker of [key]; [t_ready] is
+        the time the job became ready, from which its waiting time is
+        counted. As for [multiprocessing.Pool.apply_async], [callback]
+        is called with the result, or [error_callback] with the
+        exception raised.'''
+        result = AffinityResult(callback, error_callback)
+        if t_ready is None:
+            t_ready = time.time()
+        job = (func, args, result, t_ready)
+        with self._lock:
+            if key is None:
+                self._queue_any.append(job)
+            else:
+                self._queues[self.home(key)].append(job)
+        return result
+
+    def _next_job(self, i):
+        '''Return the next job for idle worker [i], or None.'''
+        if self._queues[i]:
+            return self._queues[i].pop(0)
+        if self._queue_any:
+            return self._queue_any.pop(0)
+        t_steal = time.time() - set_blackbox.affinity_steal_wait
+        jobs = [(queue[0][3], k) for k, queue in enumerate(self._queues)
+                if queue and queue[0][3] <= t_steal]
+        if jobs:
+            self._stats[i]['stolen'] += 1
+            return self._queues[min(jobs)[1]].pop(0)
+        return None
+
+    def _dispatch(self):
+        while not self._stop.is_set():
+            with self._lock:
+                for i in range(self._nproc):
+                    if self._running[i] is not None and self._running[i][0].ready():
+                        inner, result = self._running[i]
+                        self._running[i] = None
+                        try:
+                            value, cache = inner.get()
+                        except Exception as e:
+                            result._set(exc=e)
+                        else:
+                            self._stats[i]['cache'] = cache
+                            result._set(value=value)
+                    if self._running[i] is None:
+                        job = self._next_job(i)
+                        if job is not None:
+                            func, args, result, t_submit = job
+                            self._running[i] = (self._pools[i].apply_async(
+                                affinity_job, (func, args)), result)
+                            self._stats[i]['jobs'] += 1
+            time.sleep(0.05)
+
+    def stats(self):
+        '''Return the number of jobs run and stolen and the cache hit
+        rates of each worker.'''
+        stats = []
+        with self._lock:
+            for i in range(self._nproc):
+                stats_worker = {'worker': i, 'jobs': self._stats[i]['jobs'],
+                                'stolen': self._stats[i]['stolen']}
+                for name, (hits, misses) in self._stats[i]['cache'].items():
+                    if hits + misses > 0:
+                        stats_worker['{}_hit_rate'.format(name)] = (
+                            round(float(hits) / (hits+misses), 3))
+                stats.append(stats_worker)
+        return stats
+
+    def close(self):
+        '''Wait for the queued jobs to be submitted, close the workers
+        and log their statistics.'''
+        while True:
+            with self._lock:
+                if not self._queue_any and not any(self._queues):
+                    break
+            time.sleep(0.1)
+        for pool in self._pools:
+            pool.close()
+
+    def join(self):
+        for pool in self._pools:
+            pool.join()
+        # collect the results of the last jobs
+        while True:
+            with self._lock:
+                if not any(self._running):
+                    break
+            time.sleep(0.1)
+        self._stop.set()
+        self._thread.join()
+        for stats_worker in self.stats():
+            q.put(logger.info('affinity worker: {}'.format(stats_worker)))
+
+
+class AffinityResult(object):
+    '''Result of a job submitted to [AffinityPool].'''
+
+    def __init__(self, callback=None, error_callback=None):
+        self._event = threading.Event()
+        self._value = None
+        self._exc = None
+        self._callback = callback
+        self._error_callback = error_callback
+
+    def _set(self, value=None, exc=None):
+        self._value = value
+        self._exc = exc
+        if exc is None and self._callback is not None:
+            self._callback(value)
+        if exc is not None and self._error_callback is not None:
+            self._error_callback(exc)
+        self._event.set()
+
+    def ready(self):
+        return self._event.is_set()
+
+    def get(self):
+        self._event.wait()
+        if self._exc is not None:
+            raise self._exc
+        return self._value
+
+
+def affinity_job (func, args):
+
+    """Function that runs [func] with [args] in a worker of
+       [AffinityPool] and returns its result together with the
+       (hits, misses) of the caches of the worker."""
+
+    value = func(*args)
+    cache = {'master': (master_cache_stats['hits'], master_cache_stats['misses']),
+             'bpm': (bpm_cache_stats['hits'], bpm_cache_stats['misses']),
+             'ref': (ref_cache_stats['hits'], ref_cache_stats['misses'])}
+    return value, cache
+
+
+def affinity_hash (key):
+
+    """Function that returns a hash of [key] that is the same in
+       every process and run."""
+
+    return int(hashlib.md5(repr(key).encode()).hexdigest()[0:8], 16)
+
+
+def affinity_key (header):
+
+    """Function that returns the key with which the reduction of the
+       raw image with [header] is routed by [AffinityPool]: the field
+       and filter for object images, so that they reuse the same
+       reference, and the filter for flats, so that they reuse the
+       same master bias and bad pixel mask; bias frames can go
+       anywhere."""
+
+    imgtype = header['IMAGETYP'].lower()
+    if 'object' in imgtype:
+        return (get_obj(header), header['FILTER'])
+    elif 'flat' in imgtype:
+        return ('flat', header['FILTER'])
+    return None
 
 
 ################################################################################
 
-class FileWatcher(FileSystemEventHandler, object):
-    '''Monitors directory for new files.
+# inotify event masks, see /usr/include/linux/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+
+def inotify_watch(path, mask):
+
+    """Function that creates an inotify instance watching directory
+       [path] for the events in [mask] and returns its file
+       descriptor. Raises OSError if inotify is not available, e.g. on
+       a non-Linux system.
+
+    """
+
+    libname = ctypes.util.find_library('c')
+    try:
+        libc = ctypes.CDLL(libname, use_errno=True)
+        inotify_init1 = libc.inotify_init1
+        inotify_add_watch = libc.inotify_add_watch
+    except (OSError, AttributeError) as e:
+        raise OSError('inotify not available: {}'.format(e))
+
+    fd = inotify_init1(0)
+    if fd < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+    wd = inotify_add_watch(fd, path.encode(), ctypes.c_uint32(mask))
+    if wd < 0:
+        errno = ctypes.get_errno()
+        os.close(fd)
+        raise OSError(errno, os.strerror(errno), path)
+
+    return fd
+
+
+################################################################################
+
+class Ingestor(object):
+    '''Hands new raw images in [read_path] to the night-mode queue.
+
+    On Linux, the directory is watched with inotify for files that are
+    closed after writing (IN_CLOSE_WRITE) or moved into it
+    (IN_MOVED_TO), so that a file is put on the queue as soon as it is
+    complete. Elsewhere, the watchdog observer is used and the file is
+    put on the queue once its size is stable (see [copying]), in a
+    separate thread so that the other files are not held up. Each file
+    is put on the queue only once, and the reduced images and masks are
+    ignored.
+
+    :param queue: queue for new files
+    :type queue: NightQueue'''
 
-    :param queue: multiprocessing queue for new files
-    :type queue: multiprocessing.Queue'''
-    
     def __init__(self, queue, telescope, mode, read_path):
         self._queue = queue
         self._telescope = telescope
         self._mode = mode
         self._read_path = read_path
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._fd = None
+        self._thread = None
+        self._observer = None
+
+    def start(self):
+        '''Start watching [read_path] for new files.'''
+        try:
+            self._fd = inotify_watch(self._read_path,
+                                     IN_CLOSE_WRITE | IN_MOVED_TO)
+        except OSError as e:
+            q.put(logger.info('using watchdog to monitor {}; {}'
+                              .format(self._read_path, e)))
+            self._observer = Observer()
+            self._observer.schedule(FileWatcher(self), self._read_path,
+                                    recursive=False)
+            self._observer.start()
+        else:
+            q.put(logger.info('using inotify to monitor {}'
+                              .format(self._read_path)))
+            self._thread = threading.Thread(target=self._read_events)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        '''Stop watching [read_path].'''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            os.close(self._fd)
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+
+    def _claim(self, filename):
+        '''Return True if [filename] is a raw image that was not seen
+        before, and mark it as seen.'''
+        name = filename.split('/')[-1]
+        # skip hidden files, such as the temporary files of rsync
+        if ('fits' not in name or name.startswith('.') or
+            '_red' in name or '_mask' in name):
+            return False
+        with self._lock:
+            if filename in self._queued:
+                return False
+            self._queued.add(filename)
+        return True
+
+    def _submit(self, filename):
+        q.put(logger.info('Found new file '+filename))
+        self._queue.put([filename, self._telescope, self._mode,
+                         self._read_path])
+
+    def put(self, filename):
+        '''Put complete [filename] on the queue.'''
+        if self._claim(filename):
+            self._submit(filename)
+
+    def put_stable(self, filename, wait=True):
+        '''Put [filename] on the queue once its size is stable; if
+        [wait] is False, this is done in a separate thread.'''
+        if not self._claim(filename):
+            return
+        if not wait:
+            thread = threading.Thread(target=self._submit_stable,
+                                      args=(filename,))
+            thread.daemon = True
+            thread.start()
+        else:
+            self._submit_stable(filename)
+
+    def _submit_stable(self, filename):
+        try:
+            copying(filename) #check to see if write is finished writing
+        except OSError:
+            # file was removed or renamed in the meantime
+            return
+        self._submit(filename)
+
+    def _read_events(self):
+        '''Read the inotify events and put the files on the queue.'''
+        while not self._stop.is_set():
+            # wake up every second to check if watching should stop
+            if not select.select([self._fd], [], [], 1)[0]:
+                continue
+            buf = os.read(self._fd, 65536)
+            i = 0
+            while i < len(buf):
+                # struct inotify_event: int wd; uint32_t mask, cookie,
+                # len; char name[len] (null-padded)
+                wd, mask, cookie, length = struct.unpack_from('iIII', buf, i)
+                name = buf[i+16:i+16+length].rstrip(b'\0').decode()
+                i += 16 + length
+                if mask & IN_Q_OVERFLOW:
+                    # events were lost; pick up any files that were
+                    # not seen yet, which may still be written
+                    q.put(logger.warn('inotify queue overflowed; '
+                                      'rescanning {}'.format(self._read_path)))
+                    for filename in sorted(glob.glob(self._read_path+'/*fits*')):
+                        self.put_stable(filename, wait=False)
+                elif name:
+                    self.put('{}/{}'.format(self._read_path, name))
+
+
+################################################################################
+
+class FileWatcher(FileSystemEventHandler, object):
+    '''Monitors directory for new files with watchdog.
+
+    :param ingestor: ingestor that puts the new files on the queue
+    :type ingestor: Ingestor'''
+    
+    def __init__(self, ingestor):
+        self._ingestor = ingestor
         
     def on_created(self, event):
         '''Action to take for new files.
 
         :param event: new event found
         :type event: event'''
-        self._queue.put([event, self._telescope, self._mode, self._read_path])
+        if not event.is_directory:
+            self._ingestor.put_stable(str(event.src_path), wait=False)
+
+    def on_moved(self, event):
+        '''Action to take for files moved into the directory, which
+        are complete.
+
+        :param event: new event found
+        :type event: event'''
+        if not event.is_directory:
+            self._ingestor.put(str(event.dest_path))
 
         
 ################################################################################
@@ -1932,8 +4506,13 @@ if __name__ == "__main__":
     params.add_argument('--date', type=str, default=None, help='Date to process (yyyymmdd, yyyy-mm-dd, yyyy/mm/dd or yyyy.mm.dd)')
     params.add_argument('--read_path', type=str, default=None, help='Full path to the input raw data directory; if not defined it is determined from [set_blackbox.raw_dir], [telescope] and [date]')
     params.add_argument('--slack', default=True, help='Upload messages for night mode to slack.')
+    params.add_argument('--rebuild_cal_index', action='store_true', help='Rebuild the calibration index of master biases and flats from [set_blackbox.red_dir] and exit')
     args = params.parse_args()
 
+    if args.rebuild_cal_index:
+        rebuild_cal_index()
+        raise SystemExit
+
     run_blackbox (telescope=args.telescope, mode=args.mode, date=args.date, read_path=args.read_path, slack=args.slack)
 
 